@@ -21,6 +21,12 @@ fi
 
 EPISODE_FILENAME=$2
 
+# IC_PIPELINE_MODE=fused runs phases 1-3 in a single process, passing results in memory
+if [ "$IC_PIPELINE_MODE" == "fused" ]; then
+  python3 -um infinitechallenge.pipeline.fused $CONFIG_FILE_PATH $EPISODE_FILENAME
+  exit $?
+fi
+
 python3 -um infinitechallenge.pipeline.phase1 $CONFIG_FILE_PATH $EPISODE_FILENAME
 #python3 -um infinitechallenge.pipeline.phase2 $CONFIG_FILE_PATH $EPISODE_FILENAME
 #python3 -um infinitechallenge.pipeline.phase3 $CONFIG_FILE_PATH $EPISODE_FILENAME
@@ -7,6 +7,7 @@ DOCKER_IMAGE= #docker image
 
 docker run \
   --rm \
+  -e IC_PIPELINE_MODE=phases \
   -e IC_RDS_PASSWORD= \
   -e IC_AZURE_KEY_SKULL= \
   -e IC_AZURE_KEY_FACE= \
@@ -1,69 +1,131 @@
 from imutils import paths
 import face_recognition
 import argparse
-import pickle
-import cv2
-import os
-from logger import logger
-from datetime import date
 import configparser
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+import cv2
+import numpy as np
+from infinitechallenge.logging import logger
+from infinitechallenge.model.known_faces import KnownFaces
 
-#Description: Creating serialized encodings of members' faces in a pickle file
+#Description: Creating an encodings store of members' faces
 #Developed: 24 June 2020
 #Developer: Ko Gi Hun
 
+# The manifest (<store>.manifest.json) records, for every encoded image, its content hash and the rows of the store
+# holding its encodings. Re-runs only encode new or changed images and keep the encodings of unchanged ones.
+MANIFEST_VERSION = 1
+
 # Initialise strings from config file
 config = configparser.ConfigParser()
 config.read('strings.ini')
 
-#Initializing arg parser
-ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--dataset", type=str, default=config['ENCODING']['path_known_faces'],
-                help = "path to input directory of faces + images")
-ap.add_argument("-e", "--encodings", type=str, default=config['MAIN']['path_encodings'],
-                help = "path dir to serialized db of facial encodings")
-ap.add_argument("-d", "--detection-method", type=str, default="cnn",
-                help = "face detection model to use: either 'hog' or 'cnn'")
-args = vars(ap.parse_args())
 
-if __name__ == "__main__":
-    logger.info('quantifying faces..')
-    imagePaths = list(paths.list_images(args["dataset"]))
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
-    #Initializing the list of known encodings and known names
-    knownEncodings = []
-    knownNames = []
 
-    #Looping through the dataset images for encoding
-    for (i, imagePath) in enumerate(imagePaths):
-        name = imagePath.split(os.path.sep)[-2]
-        logger.info("Processing image of {} {}: {}/{}".format(name, imagePath, i + 1, len(imagePaths)))
+def encode_image(job):
+    imagePath, detection_method = job
+    #loading the image and convert it from BGR (Opencv ordering)
+    #To dlib ordering(RGB)
+    image = cv2.imread(imagePath)
+    if image is None:
+        logger.warning("Unable to read image: {}".format(imagePath))
+        return imagePath, []
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    #1. Detect the (x, y) coordinates of the bounding boxes
+    #corresponding to each face in the input image
+    boxes = face_recognition.face_locations(rgb, model=detection_method)
+
+    #2. Compute the facial embedding for the face
+    return imagePath, face_recognition.face_encodings(rgb, boxes)
 
-        #loading the image and convert it from BGR (Opencv ordering)
-        #To dlib ordering(RGB)
-        image = cv2.imread(imagePath)
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-        #1. Detect the (x, y) coordinates of the bounding boxes
-        #corresponding to each face in the input image
-        boxes = face_recognition.face_locations(rgb, model = args["detection_method"])
+def manifest_path(store_path):
+    return store_path.rstrip(os.path.sep) + '.manifest.json'
 
-        #2. Compute the facial embedding for the face
-        encodings = face_recognition.face_encodings(rgb, boxes)
 
-        #3. Loop over the encodings
-        for encoding in encodings:
-            # Add encoding + name to our set of known names and encodings
-            knownEncodings.append(encoding)
-            knownNames.append(name)
+def load_existing(store_path):
+    """ Loads the existing store and its manifest, returns (None, {}) if either is missing or they do not agree """
+    try:
+        with open(manifest_path(store_path), encoding='utf8') as f:
+            manifest = json.load(f)
+        known_faces = KnownFaces.load(store_path, mmap=False)
+    except (FileNotFoundError, ValueError) as ex:
+        logger.info("No usable existing encodings store ({}), encoding all images".format(ex))
+        return None, {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('count') != len(known_faces):
+        logger.warning("Manifest does not match encodings store, encoding all images")
+        return None, {}
+    return known_faces, manifest['images']
+
+
+if __name__ == "__main__":
+    #Initializing arg parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--dataset", type=str, default=config.get('ENCODING', 'path_known_faces', fallback=None),
+                    help="path to input directory of faces + images")
+    ap.add_argument("-e", "--encodings", type=str, default=config['MAIN']['path_encodings'],
+                    help="path dir to encodings store of facial encodings")
+    ap.add_argument("-s", "--store", type=str, default="known_faces",
+                    help="name of the encodings store within the encodings dir")
+    ap.add_argument("-d", "--detection-method", type=str, default="cnn",
+                    help="face detection model to use: either 'hog' or 'cnn'")
+    ap.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                    help="number of processes encoding images in parallel")
+    ap.add_argument("-f", "--full", action="store_true",
+                    help="ignore the existing store and re-encode every image")
+    args = vars(ap.parse_args())
+    if args["dataset"] is None:
+        ap.error("the following arguments are required: -i/--dataset")
+
+    store_path = os.path.join(args["encodings"], args["store"])
+    existing, existing_images = (None, {}) if args["full"] else load_existing(store_path)
+
+    logger.info('quantifying faces..')
+    imagePaths = sorted(paths.list_images(args["dataset"]))
+    hashes = {imagePath: file_hash(imagePath) for imagePath in imagePaths}
+    changed = [imagePath for imagePath in imagePaths
+               if existing_images.get(imagePath, {}).get('sha1') != hashes[imagePath]]
+    logger.info("{} images, {} new or changed".format(len(imagePaths), len(changed)))
+
+    #Looping through the new and changed dataset images for encoding, spread across processes
+    new_encodings = {}
+    with Pool(processes=args["workers"]) as pool:
+        jobs = [(imagePath, args["detection_method"]) for imagePath in changed]
+        for (i, (imagePath, encodings)) in enumerate(pool.imap_unordered(encode_image, jobs)):
+            logger.info("Processed image {}: {}/{} ({} faces)".format(imagePath, i + 1, len(changed), len(encodings)))
+            new_encodings[imagePath] = encodings
+
+    #Merging into the known encodings, names and manifest, in dataset order
+    knownEncodings = []
+    knownNames = []
+    images = {}
+    for imagePath in imagePaths:
+        name = imagePath.split(os.path.sep)[-2]
+        if imagePath in new_encodings:
+            encodings = new_encodings[imagePath]
+        else:
+            start, stop = existing_images[imagePath]['rows']
+            encodings = existing.encodings[start:stop]
+        images[imagePath] = {'sha1': hashes[imagePath], 'rows': [len(knownEncodings), len(knownEncodings) + len(encodings)]}
+        knownEncodings += list(encodings)
+        knownNames += [name] * len(encodings)
 
-    # Serialization of encodings into file and save
+    # Serialization of encodings into the store and save
     logger.info("serializing encodings...")
-    data = {"encodings": knownEncodings, "names": knownNames}
-    str_filepath = "encodings_" + date.today().strftime("%d_%b_%y") + ".pickle"
-    str_filepath = os.path.join(args["encodings"], str_filepath)
-
-    f = open(str_filepath, "wb")
-    f.write(pickle.dumps(data))
-    f.close()
-    logger.info("finished encoding serialization: {}".format(str_filepath))
\ No newline at end of file
+    known_faces = KnownFaces.from_data({"encodings": np.array(knownEncodings, dtype=np.float32).reshape(-1, 128),
+                                        "names": knownNames})
+    known_faces.save(store_path)
+    with open(manifest_path(store_path), "w", encoding="utf8") as f:
+        json.dump({"version": MANIFEST_VERSION, "count": len(known_faces), "images": images}, f, ensure_ascii=False)
+    logger.info("finished encoding serialization: {}".format(store_path))
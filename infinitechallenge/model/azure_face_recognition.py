@@ -97,7 +97,18 @@ def recognise_faces(fc, image_path, person_group_id):
     :param person_group_id: the id of the trained person group
     :return: results of detect and identify
     """
-    data = open(image_path, 'rb')
+    with open(image_path, 'rb') as data:
+        return recognise_faces_in_stream(fc, data, person_group_id)
+
+
+def recognise_faces_in_stream(fc, data, person_group_id):
+    """ Recognize faces in an encoded image stream
+
+    :param fc: FaceClient
+    :param data: binary stream of an encoded (e.g. jpeg) image
+    :param person_group_id: the id of the trained person group
+    :return: results of detect and identify
+    """
     face_ids = []
     faces = {}
 
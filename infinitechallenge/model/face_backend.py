@@ -0,0 +1,167 @@
+import os
+from io import BytesIO
+import cv2
+from infinitechallenge.model import azure_face_recognition as afr
+from infinitechallenge.model.known_faces import load_known_faces
+from infinitechallenge.logging import logger
+from infinitechallenge.utils.regions import crop, offset_boxes, relative_boxes, roi_around
+
+# Description: Interchangeable face detection & identification backends for phase 2
+# Every backend returns a list of {'bounding_box': (top, right, bottom, left), 'name': name} records
+
+
+class FaceBackend:
+    NAME_UNKNOWN = 'unknown'
+
+    def recognise_image(self, image, skull_boxes=None):
+        """ Detect and identify faces in a decoded (BGR) image
+
+        :param image: image as read by cv2.imread
+        :param skull_boxes: skull coordinates found in the image by phase 1, backends may use them as a hint
+        :return: list of {'bounding_box', 'name'} records
+        """
+        raise NotImplementedError
+
+    def recognise_file(self, image_path, skull_boxes=None):
+        """ Detect and identify faces in the image stored at image_path
+
+        :param image_path: path to image to recognize faces in
+        :param skull_boxes: see recognise_image
+        :return: list of {'bounding_box', 'name'} records
+        """
+        return self.recognise_image(read_image(image_path), skull_boxes)
+
+    def recognise_files(self, image_paths, skull_boxes=None):
+        """ Detect and identify faces in many images, backends that can process images together override this
+
+        :param image_paths: paths to images to recognize faces in
+        :param skull_boxes: list of skull coordinates for each image, see recognise_image
+        :return: list of {'bounding_box', 'name'} record lists, one for each image
+        """
+        skull_boxes = skull_boxes or [None] * len(image_paths)
+        return [self.recognise_file(image_path, boxes) for image_path, boxes in zip(image_paths, skull_boxes)]
+
+    def recognise_roi(self, image, skull_boxes, expansion):
+        """ Detect and identify faces only in a window around the skulls of an image (the whole image if it has no
+        skulls), the burned member's face is expected to be near the skulls
+
+        :param image: image as read by cv2.imread
+        :param skull_boxes: skull coordinates found in the image by phase 1
+        :param expansion: ratio of the window's sides to each skull's sides
+        :return: list of {'bounding_box', 'name'} records, bounding boxes in the image's coordinates
+        """
+        if not skull_boxes:
+            return self.recognise_image(image, skull_boxes)
+        region = roi_around(skull_boxes, expansion, image.shape)
+        faces = self.recognise_region(image, region, relative_boxes(skull_boxes, region))
+        for face in faces:
+            face['bounding_box'] = offset_boxes([face['bounding_box']], region)[0]
+        return faces
+
+    def recognise_region(self, image, region, skull_boxes=None):
+        """ Detect and identify faces in a region of an image
+
+        :param image: image as read by cv2.imread
+        :param region: (top, right, bottom, left) of the region
+        :param skull_boxes: skull coordinates relative to the region
+        :return: list of {'bounding_box', 'name'} records, bounding boxes relative to the region
+        """
+        return self.recognise_image(crop(image, region), skull_boxes)
+
+    def close(self):
+        """ Releases what the backend holds on to between images (e.g. worker processes) """
+        pass
+
+
+class AzureFaceBackend(FaceBackend):
+    def __init__(self, endpoint, key, person_group_id):
+        self.person_group_id = person_group_id
+        self.faceclient = afr.authenticate_client(endpoint, key)
+
+    def recognise_image(self, image, skull_boxes=None):
+        ret, jpeg = cv2.imencode('.jpg', image)
+        return afr.recognise_faces_in_stream(self.faceclient, BytesIO(jpeg.tobytes()), self.person_group_id)
+
+    def recognise_file(self, image_path, skull_boxes=None):
+        # upload the encoded file as is, no need to decode and re-encode it
+        return afr.recognise_faces(self.faceclient, image_path, self.person_group_id)
+
+
+class LocalFaceBackend(FaceBackend):
+    def __init__(self, known_face_encodings_path, detection_method, use_index=False, expected_faces=1, workers=0):
+        # face_recognition (dlib) is not part of the docker image, only import it when the local backend is used
+        from infinitechallenge.model import frame_recognition
+        self.fr = frame_recognition
+        logger.info(f'Loading known face encodings from {known_face_encodings_path}...')
+        self.known_faces = load_known_faces(known_face_encodings_path, index=use_index)
+        self.detection_method = detection_method
+        self.expected_faces = expected_faces
+        # worker processes detecting the images of recognise_files batches, started on first use and kept until close
+        self.workers = workers
+        self.pool = None
+
+    def recognise_image(self, image, skull_boxes=None):
+        boxes, encodings = self.fr.locate_faces(image, self.detection_method, self.expected_faces, skull_boxes)
+        names = self.fr.process_recognition(self.known_faces, encodings)
+        return LocalFaceBackend._to_faces(boxes, names)
+
+    def recognise_region(self, image, region, skull_boxes=None):
+        # detect at the scale the whole image would be detected at, rather than enlarging the region to full width
+        region_image = crop(image, region)
+        width = max(1, round(region_image.shape[1] * self.fr.RESIZE_WIDTH / image.shape[1]))
+        boxes, encodings = self.fr.locate_faces(region_image, self.detection_method, self.expected_faces, skull_boxes,
+                                                width=width)
+        names = self.fr.process_recognition(self.known_faces, encodings)
+        return LocalFaceBackend._to_faces(boxes, names)
+
+    def recognise_files(self, image_paths, skull_boxes=None):
+        images = [read_image(image_path) for image_path in image_paths]
+        if self.workers > 0 and self.pool is None:
+            from multiprocessing import Pool
+            self.pool = Pool(processes=self.workers)
+        located = self.fr.locate_faces_batch(images, self.detection_method, pool=self.pool,
+                                             expected_faces=self.expected_faces, skull_boxes=skull_boxes)
+        names_per_image = self.fr.process_recognition_many(self.known_faces,
+                                                           [encodings for boxes, encodings in located])
+        return [LocalFaceBackend._to_faces(boxes, names) for (boxes, encodings), names in zip(located, names_per_image)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    @staticmethod
+    def _to_faces(boxes, names):
+        faces = []
+        for box, name in zip(boxes, names):
+            # face_recognition labels unmatched faces 'Unknown', azure (and phase 3) use 'unknown'
+            name = FaceBackend.NAME_UNKNOWN if name == 'Unknown' else name
+            logger.info(f'{name} was identified at {box}')
+            faces.append({'bounding_box': box, 'name': name})
+        return faces
+
+
+def read_image(image_path):
+    image = cv2.imread(image_path)
+    if image is None:
+        raise FileNotFoundError(f'Unable to read image: {image_path}')
+    return image
+
+
+def create_face_backend(config):
+    """ Creates the face backend selected by the 'face_backend' option of the given config section
+
+    :param config: config section (e.g. config['Phase2'])
+    :return: FaceBackend
+    """
+    backend = config.get('face_backend', 'azure').lower()
+    if backend == 'azure':
+        return AzureFaceBackend(config['endpoint'], os.environ['IC_AZURE_KEY_FACE'], config['person_group_id'])
+    elif backend == 'local':
+        return LocalFaceBackend(config['known_face_encodings'],
+                                config.get('detection_method', 'hog'),
+                                config.getboolean('face_index', False),
+                                config.getint('cascade_expected_faces', 1),
+                                config.getint('face_workers', 0))
+    raise ValueError(f'Unknown face backend: {backend}')
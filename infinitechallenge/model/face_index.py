@@ -0,0 +1,157 @@
+import math
+import numpy as np
+
+# Description: Nearest neighbour index over the known face encodings
+# Encodings are partitioned into small clusters (per person, then k-means within each person) and each cluster keeps
+# its centroid and radius. By the triangle inequality a cluster can only hold an encoding within distance t of a
+# query q if |q - centroid| - radius <= t, so whole clusters are skipped before computing exact distances.
+# Results are exact: the same encodings are returned as with a linear scan.
+
+
+class EncodingIndex:
+    DEFAULT_LEAF_SIZE = 64
+    KMEANS_ITERATIONS = 5
+    SLACK = 1e-4  # absorbs float32 rounding so that pruning never drops a true match
+
+    def __init__(self, encodings, labels, leaf_size=DEFAULT_LEAF_SIZE, seed=0):
+        """
+        :param encodings: (n, d) matrix of known encodings
+        :param labels: (n,) person label of each encoding, clusters never mix people
+        :param leaf_size: target number of encodings per cluster
+        """
+        self.encodings = encodings
+        self.leaf_size = leaf_size
+        rng = np.random.default_rng(seed)
+        clusters = []
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            clusters += self._split(members, rng)
+        self.order = np.concatenate(clusters) if clusters else np.zeros(0, dtype=np.int64)
+        self.offsets = np.cumsum([0] + [len(cluster) for cluster in clusters])
+        self.centroids = np.array([encodings[cluster].mean(axis=0, dtype=np.float64) for cluster in clusters],
+                                  dtype=np.float64).reshape(len(clusters), encodings.shape[1])
+        self.radii = np.array([np.linalg.norm(encodings[cluster] - centroid, axis=1).max()
+                               for cluster, centroid in zip(clusters, self.centroids)], dtype=np.float64)
+
+    def _split(self, members, rng):
+        """ Splits members into clusters of about leaf_size encodings using a few k-means iterations """
+        k = math.ceil(len(members) / self.leaf_size)
+        if k <= 1:
+            return [members]
+        points = self.encodings[members]
+        centres = points[rng.choice(len(points), size=k, replace=False)]
+        for _ in range(EncodingIndex.KMEANS_ITERATIONS):
+            assignment = _squared_distances(points, centres).argmin(axis=1)
+            for j in range(k):
+                assigned = points[assignment == j]
+                if len(assigned):
+                    centres[j] = assigned.mean(axis=0)
+        assignment = _squared_distances(points, centres).argmin(axis=1)
+        return [members[assignment == j] for j in range(k) if np.any(assignment == j)]
+
+    def _cluster_members(self, cluster_ids):
+        if len(cluster_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.order[self.offsets[j]:self.offsets[j + 1]] for j in cluster_ids])
+
+    def _lower_bounds(self, queries):
+        """ Lower bound of the distance between each query and any encoding of each cluster """
+        queries = np.asarray(queries, dtype=np.float64)
+        centroid_distances = np.sqrt(np.maximum(_squared_distances(queries, self.centroids), 0.0))
+        return centroid_distances - self.radii[np.newaxis, :]
+
+    def candidates(self, queries, tolerance):
+        """ Finds the known encodings that may be within tolerance of each query, i.e. the members of every cluster
+        that could not be ruled out
+
+        :param queries: (m, d) matrix of encodings
+        :param tolerance: maximum distance
+        :return: list of m sorted arrays of encoding indexes
+        """
+        lower_bounds = self._lower_bounds(queries)
+        return [np.sort(self._cluster_members(np.flatnonzero(bounds <= tolerance + EncodingIndex.SLACK)))
+                for bounds in lower_bounds]
+
+    def within(self, queries, tolerance):
+        """ Finds every known encoding within tolerance of each query
+
+        :param queries: (m, d) matrix of encodings
+        :param tolerance: maximum distance
+        :return: (rows, cols) arrays, queries[rows[i]] is within tolerance of encodings[cols[i]], sorted by row then col
+        """
+        rows = []
+        cols = []
+        for row, candidates in enumerate(self.candidates(queries, tolerance)):
+            distances = np.linalg.norm(self.encodings[candidates] - queries[row], axis=1)
+            matched = candidates[distances <= tolerance]
+            rows.append(np.full(len(matched), row, dtype=np.int64))
+            cols.append(matched)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(cols)
+
+    def nearest(self, query, k=1):
+        """ Finds the k known encodings nearest to the query, visiting clusters in order of their lower bound and
+        stopping once no remaining cluster can hold a closer encoding
+
+        :param query: (d,) encoding
+        :param k: number of neighbours
+        :return: (indexes, distances) of the k nearest encodings, closest first
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        lower_bounds = self._lower_bounds(query)[0]
+        best_indexes = np.zeros(0, dtype=np.int64)
+        best_distances = np.zeros(0, dtype=np.float64)
+        for j in np.argsort(lower_bounds):
+            if len(best_distances) == k and lower_bounds[j] > best_distances[-1] + EncodingIndex.SLACK:
+                break
+            members = self.order[self.offsets[j]:self.offsets[j + 1]]
+            distances = np.linalg.norm(self.encodings[members] - query, axis=1)
+            best_indexes = np.concatenate([best_indexes, members])
+            best_distances = np.concatenate([best_distances, distances])
+            closest = np.argsort(best_distances, kind='stable')[:k]
+            best_indexes, best_distances = best_indexes[closest], best_distances[closest]
+        return best_indexes, best_distances
+
+
+def _squared_distances(a, b):
+    squared = np.einsum('ij,ij->i', a, a)[:, np.newaxis] + np.einsum('ij,ij->i', b, b)[np.newaxis, :] - 2.0 * (a @ b.T)
+    return squared.astype(np.float64)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from infinitechallenge.logging import logger
+    # Benchmark: linear scan vs index on synthetic clustered encodings (about 100 reference photos per person)
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    ap.add_argument('-q', '--queries', type=int, default=200)
+    ap.add_argument('-t', '--tolerance', type=float, default=0.6)
+    args = vars(ap.parse_args())
+
+    rng = np.random.default_rng(0)
+    for size in args['sizes']:
+        people = max(1, size // 100)
+        centres = rng.normal(scale=0.4, size=(people, 128))
+        labels = rng.integers(0, people, size=size)
+        encodings = (centres[labels] + rng.normal(scale=0.025, size=(size, 128))).astype(np.float32)
+        queries = (centres[rng.integers(0, people, size=args['queries'])]
+                   + rng.normal(scale=0.025, size=(args['queries'], 128))).astype(np.float32)
+
+        start = time.perf_counter()
+        index = EncodingIndex(encodings, labels)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear = [np.flatnonzero(np.linalg.norm(encodings - query, axis=1) <= args['tolerance'])
+                  for query in queries]
+        linear_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        indexed = [index.within(query[np.newaxis, :], args['tolerance'])[1] for query in queries]
+        index_time = (time.perf_counter() - start) / len(queries)
+        assert all(np.array_equal(a, b) for a, b in zip(linear, indexed))
+
+        logger.info(f'{size} encodings ({people} people, {len(index.radii)} clusters): build {build_time:.2f}s, '
+                    f'linear {linear_time * 1000:.3f}ms/query, indexed {index_time * 1000:.3f}ms/query')
@@ -1,8 +1,13 @@
 import face_recognition
 import os
+import time
+from multiprocessing import Pool
 import cv2
 import imutils
 from infinitechallenge.logging import logger
+from infinitechallenge.model.known_faces import KnownFaces, load_known_faces
+from infinitechallenge.utils.regions import scale_box, expand_box, crop, offset_boxes, merge_boxes, \
+    intersection_over_union
 
 
 class ProcessedImage:
@@ -34,42 +39,38 @@ def fetch_unprocessed_img(img_path):
 
 # matches unknown encodings (encoding) with known encodings in data
 def process_recognition(data, encodings):
-    names = []
-    # Recognition and Comparing faces in the database
-    for encoding in encodings:
-        # attempt to match each face in the input image to our known encodings
-        matches = face_recognition.compare_faces(data["encodings"], encoding)
-        name = "Unknown"
+    known_faces = KnownFaces.from_data(data)
+    return known_faces.match(encodings)
 
-        if True in matches:
-            matchedIdxs = [i for (i, b) in enumerate(matches) if b]
-            counts = {}
 
-            for i in matchedIdxs:
-                name = data["names"][i]
-                counts[name] = counts.get(name, 0) + 1
+# matches the unknown encodings of many frames in a single distance matrix computation
+def process_recognition_many(data, encodings_per_frame):
+    known_faces = KnownFaces.from_data(data)
+    flattened = [encoding for encodings in encodings_per_frame for encoding in encodings]
+    names = known_faces.match(flattened)
+    names_per_frame = []
+    start = 0
+    for encodings in encodings_per_frame:
+        names_per_frame.append(names[start:start + len(encodings)])
+        start += len(encodings)
+    return names_per_frame
 
-            name = max(counts, key=counts.get)
-        names.append(name)
-    return names
 
+RESIZE_WIDTH = 280
 
-def locate_faces(image, detection_method):
-    logger.info("Resizing face...")
 
+def resize_for_detection(image, width=RESIZE_WIDTH):
     # convert to rgb
     rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     # resize
-    rgb = imutils.resize(rgb, width=280)
+    rgb = imutils.resize(rgb, width=width)
 
     # resize factor
     r = image.shape[1] / float(rgb.shape[1])
+    return rgb, r
 
-    # Detecting the coordinates of the bounding boxes corresponding to each face in the input image
-    # then compute the facial embeddings for each face
-    logger.info("Recognizing faces...")
-    resized_boxes = face_recognition.face_locations(rgb, model=detection_method)
-    encodings_of_detected_faces = face_recognition.face_encodings(rgb, resized_boxes)
+
+def rescale_boxes(resized_boxes, r):
     boxes = []
     for (a, b, c, d) in resized_boxes:
         a = int(a * r)
@@ -77,7 +78,172 @@ def locate_faces(image, detection_method):
         c = int(c * r)
         d = int(d * r)
         boxes.append((a, b, c, d))
-    return boxes, encodings_of_detected_faces
+    return boxes
+
+
+def locate_faces(image, detection_method, expected_faces=1, skull_boxes=None, width=RESIZE_WIDTH):
+    """ Locates and encodes the faces in an image
+
+    :param image: image as read by cv2.imread
+    :param detection_method: face detection model to use: 'hog', 'cnn' or 'cascade' (see cascade_face_locations)
+    :param expected_faces: for 'cascade', the number of faces below which cnn is used as a fall back
+    :param skull_boxes: for 'cascade', skull coordinates in the image, restricts the cnn fall back to their vicinity
+    :param width: width the image is resized to for detection
+    :return: (boxes, encodings) of the detected faces, boxes in the image's coordinates
+    """
+    logger.info("Resizing face...")
+    rgb, r = resize_for_detection(image, width)
+
+    # Detecting the coordinates of the bounding boxes corresponding to each face in the input image
+    # then compute the facial embeddings for each face
+    logger.info("Recognizing faces...")
+    if detection_method == 'cascade':
+        resized_skull_boxes = [scale_box(box, 1 / r) for box in skull_boxes] if skull_boxes else None
+        resized_boxes = cascade_face_locations(rgb, expected_faces, resized_skull_boxes)
+    else:
+        resized_boxes = face_recognition.face_locations(rgb, model=detection_method)
+    encodings_of_detected_faces = face_recognition.face_encodings(rgb, resized_boxes)
+    return rescale_boxes(resized_boxes, r), encodings_of_detected_faces
+
+
+SKULL_REGION_FACTOR = 4.0
+
+
+def cascade_face_locations(rgb, expected_faces=1, skull_boxes=None):
+    """ Runs the fast hog detector first, and the slow (but better with angled faces) cnn detector only if hog found
+    fewer faces than expected. With skull_boxes, cnn only runs on the regions around the skulls.
+
+    :param rgb: rgb image
+    :param expected_faces: number of faces below which cnn is used
+    :param skull_boxes: skull coordinates in rgb
+    :return: face boxes in rgb
+    """
+    boxes = face_recognition.face_locations(rgb, model='hog')
+    if len(boxes) >= expected_faces:
+        return boxes
+    if not skull_boxes:
+        logger.info(f"hog found {len(boxes)} faces, falling back to cnn")
+        return merge_boxes(boxes, face_recognition.face_locations(rgb, model='cnn'))
+    logger.info(f"hog found {len(boxes)} faces, falling back to cnn around {len(skull_boxes)} skulls")
+    for skull_box in skull_boxes:
+        region = expand_box(skull_box, SKULL_REGION_FACTOR, rgb.shape)
+        region_rgb = crop(rgb, region)
+        if region_rgb.size == 0:
+            continue
+        # regions are small, upsample once more so that faces are large enough for the cnn detector
+        region_boxes = face_recognition.face_locations(region_rgb, number_of_times_to_upsample=2, model='cnn')
+        boxes = merge_boxes(boxes, offset_boxes(region_boxes, region))
+    return boxes
+
+
+def _locate_faces_job(job):
+    image, detection_method, expected_faces, skull_boxes = job
+    return locate_faces(image, detection_method, expected_faces, skull_boxes)
+
+
+def locate_faces_batch(images, detection_method, batch_size=32, pool=None, expected_faces=1, skull_boxes=None):
+    """ Locates and encodes the faces in many images at once
+
+    With the cnn detector the frames are normalized to a common size (resized to RESIZE_WIDTH and zero padded to the
+    tallest frame) and detected with face_recognition.batch_face_locations, which runs the frames through the network
+    together. Batching pays off for frames of the same size, such as the frames of one episode: padding frames of
+    different sizes to the tallest one costs more than running them together saves. Other detectors have no batch API,
+    so the frames are spread across the worker processes of pool if one is given, and detected one after the other
+    otherwise.
+
+    :param images: list of images as read by cv2.imread
+    :param detection_method: face detection model to use: either 'hog' or 'cnn'
+    :param batch_size: number of frames per cnn batch
+    :param pool: multiprocessing.Pool for detectors without a batch API, created once by the caller and reused for
+        every batch (starting processes for each batch costs more than it saves)
+    :param expected_faces: see locate_faces
+    :param skull_boxes: list of skull coordinates for each image, see locate_faces
+    :return: list of (boxes, encodings) tuples, one for each image, boxes rescaled to each image's original size
+    """
+    if detection_method != 'cnn':
+        skull_boxes = skull_boxes or [None] * len(images)
+        jobs = [(image, detection_method, expected_faces, boxes) for image, boxes in zip(images, skull_boxes)]
+        if pool is None or len(images) <= 1:
+            return [_locate_faces_job(job) for job in jobs]
+        return pool.map(_locate_faces_job, jobs)
+
+    logger.info(f"Resizing {len(images)} frames...")
+    resized = [resize_for_detection(image) for image in images]
+    height = max(rgb.shape[0] for rgb, r in resized) if resized else 0
+    padded = [cv2.copyMakeBorder(rgb, 0, height - rgb.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=0)
+              for rgb, r in resized]
+
+    logger.info(f"Recognizing faces in {len(images)} frames...")
+    resized_boxes_per_frame = face_recognition.batch_face_locations(padded, batch_size=batch_size)
+    results = []
+    for (rgb, r), resized_boxes in zip(resized, resized_boxes_per_frame):
+        # a box may only extend into the padding below a frame, clamp it back into the frame
+        resized_boxes = [(top, right, min(bottom, rgb.shape[0]), left) for (top, right, bottom, left) in resized_boxes
+                         if top < rgb.shape[0]]
+        encodings = face_recognition.face_encodings(rgb, resized_boxes)
+        results.append((rescale_boxes(resized_boxes, r), encodings))
+    return results
+
+
+def benchmark_batch(image_paths, detection_method, batch_size=32, workers=None):
+    """ Compares locate_faces_batch against calling locate_faces once per image """
+    images = [cv2.imread(path) for path in image_paths]
+    start = time.perf_counter()
+    looped = [locate_faces(image, detection_method) for image in images]
+    loop_time = time.perf_counter() - start
+    pool = Pool(processes=workers) if workers else None
+    try:
+        start = time.perf_counter()
+        batched = locate_faces_batch(images, detection_method, batch_size, pool)
+        batch_time = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    faces_looped = sum(len(boxes) for boxes, encodings in looped)
+    faces_batched = sum(len(boxes) for boxes, encodings in batched)
+    logger.info(f'{len(images)} frames ({detection_method}): per image loop {loop_time:.2f}s ({faces_looped} faces), '
+                f'batch {batch_time:.2f}s ({faces_batched} faces), speed up x{loop_time / max(batch_time, 1e-9):.2f}')
+    return loop_time, batch_time
+
+
+def compare_detection_methods(image_dir, expected_faces=1, iou_threshold=0.5):
+    """ Reports faces found vs. time taken by each detection method on a labelled sample set: a phase 2 output
+    directory of frames and a results.csv whose face coordinates (reviewed phase 2 results) serve as labels
+
+    :param image_dir: directory with <ep_num>_<hr>_<min>_<sec>_<ms>.jpg frames and results.csv
+    :param expected_faces: see locate_faces
+    :param iou_threshold: minimum overlap between a detected and a labelled face for the label to count as found
+    """
+    from infinitechallenge.pipeline.results import Results
+    import glob
+    results = Results.read(os.path.join(image_dir, 'results.csv'))
+    samples = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*.jpg'))):
+        try:
+            ep, timestamp = get_metadata(path)
+            skull_boxes, face_boxes, names, burned = results.get_entry(int(ep), timestamp)
+        except (ValueError, KeyError):
+            # labelled output images (e.g. *_skull.jpg) and frames without results
+            continue
+        samples.append((cv2.imread(path), skull_boxes or [], face_boxes or []))
+    labelled_faces = sum(len(face_boxes) for image, skull_boxes, face_boxes in samples)
+
+    methods = [('hog', 'hog', False), ('cnn', 'cnn', False),
+               ('cascade', 'cascade', False), ('cascade (around skulls)', 'cascade', True)]
+    for label, detection_method, use_skulls in methods:
+        found = 0
+        recalled = 0
+        start = time.perf_counter()
+        for image, skull_boxes, face_boxes in samples:
+            boxes, encodings = locate_faces(image, detection_method, expected_faces,
+                                            skull_boxes if use_skulls else None)
+            found += len(boxes)
+            recalled += sum(1 for face_box in face_boxes
+                            if any(intersection_over_union(face_box, box) >= iou_threshold for box in boxes))
+        elapsed = time.perf_counter() - start
+        logger.info(f'{label}: {found} faces found, {recalled}/{labelled_faces} labelled faces found, '
+                    f'{elapsed:.2f}s ({elapsed / max(len(samples), 1):.3f}s/frame)')
 
 
 def label_image(image, title, boxes, names):
@@ -118,17 +284,35 @@ def process_image(image_path, known_face_encoding_data, detection_method, displa
 
 if __name__ == "__main__":
     import argparse
-    import pickle
     # Initialize arguments
     ap = argparse.ArgumentParser()
-    ap.add_argument("-e", "--encodings", required=True, help="path to serialized db of facial encodings")
+    ap.add_argument("-e", "--encodings", help="path to encodings store (or legacy pickle) of facial encodings")
     ap.add_argument("-y", "--display", type=int, default=1, help="whether or not to display output frame to screen")
-    ap.add_argument("-i", "--image", required=True, help="path to input image for recognition <ep_num>_<hr>_<min>_<sec>_<ms>.jpg")
+    ap.add_argument("-i", "--image", help="path to input image for recognition <ep_num>_<hr>_<min>_<sec>_<ms>.jpg")
     ap.add_argument("-d", "--detection-method", type=str, default="cnn")
+    ap.add_argument("-b", "--benchmark", type=str, default=None,
+                    help="path to a directory of cached frames to benchmark batch face location on")
+    ap.add_argument("--batch-size", type=int, default=32)
+    ap.add_argument("--workers", type=int, default=0, help="worker processes for detectors without a batch API")
+    ap.add_argument("-c", "--compare", type=str, default=None,
+                    help="path to a labelled phase 2 output directory to compare detection methods on")
+    ap.add_argument("--expected-faces", type=int, default=1)
     args = vars(ap.parse_args())
 
+    if args["compare"]:
+        compare_detection_methods(args["compare"], args["expected_faces"])
+        raise SystemExit(0)
+
+    if args["benchmark"]:
+        import glob
+        benchmark_batch(sorted(glob.glob(os.path.join(args["benchmark"], '*.jpg'))),
+                        args["detection_method"], args["batch_size"], args["workers"])
+        raise SystemExit(0)
+    if not args["image"] or not args["encodings"]:
+        ap.error("the following arguments are required: -e/--encodings, -i/--image")
+
     logger.info('loading encodings...')
-    data = pickle.loads(open(args["encodings"], "rb").read())
+    data = load_known_faces(args["encodings"])
     
     logger.info('processing image...')
     process_image(args['image'], data, args["detection_method"], args['display'])
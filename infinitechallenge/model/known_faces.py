@@ -0,0 +1,253 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from infinitechallenge.model.face_index import EncodingIndex
+from infinitechallenge.logging import logger
+
+# Description: Known face encodings held as one contiguous matrix for vectorized matching
+# Replaces per-face face_recognition.compare_faces calls and python vote counting
+
+# Encodings store (a directory), replaces the pickled {"encodings": [ndarray, ...], "names": [...]} files
+#   meta.json          format name, version and the name table
+#   encodings.npy      (n, 128) float32 matrix of encodings
+#   name_ids.npy       (n,) int32 index into the name table for each encoding
+#   squared_norms.npy  (n,) float64 squared norm of each encoding, saves reading the whole matrix on load
+# .npy files are memory-mapped read-only on load, so start up is near instant and the pages are shared between
+# worker processes loading the same store.
+# Every save writes a new version directory (<store>.version-*) next to the store path, which is a symlink to the
+# current version. Replacing the symlink is atomic, so a reader always finds a complete store, and the previous version
+# is kept until the next save for readers that resolved the link before it was replaced.
+STORE_FORMAT = 'infinitechallenge-encodings'
+STORE_VERSION = 1
+VERSION_INFIX = '.version-'
+
+
+class KnownFaces:
+    NAME_UNKNOWN = 'Unknown'
+    DEFAULT_TOLERANCE = 0.6  # same default as face_recognition.compare_faces
+    # distances this close to the tolerance are recomputed exactly, float32 rounding of the expanded form stays well
+    # below it
+    EXACT_MARGIN = 1e-4
+
+    def __init__(self, encodings, labels, names, squared_norms=None):
+        """
+        :param encodings: (n, 128) matrix of known face encodings
+        :param labels: (n,) array of indexes into names, one for each encoding
+        :param names: name table, names[labels[i]] is the name of encodings[i]
+        :param squared_norms: (n,) precomputed squared norms of the encodings
+        """
+        self.encodings = np.asarray(encodings, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.names = list(names)
+        assert self.encodings.ndim == 2 and len(self.encodings) == len(self.labels)
+        if squared_norms is None:
+            squared_norms = np.einsum('ij,ij->i', self.encodings, self.encodings, dtype=np.float64)
+        self.squared_norms = np.asarray(squared_norms, dtype=np.float64)
+        self.index = None
+
+    def build_index(self, leaf_size=EncodingIndex.DEFAULT_LEAF_SIZE):
+        """ Builds a nearest neighbour index so that matching no longer scans every known encoding """
+        self.index = EncodingIndex(self.encodings, self.labels, leaf_size=leaf_size)
+        return self
+
+    @classmethod
+    def from_data(cls, data, index=False):
+        """ Converts {"encodings": [ndarray, ...], "names": [...]} as serialized by encode_faces.py
+
+        :param data: dict of known encodings and names, or KnownFaces (returned as is)
+        :param index: whether to build a nearest neighbour index over the encodings
+        :return: KnownFaces
+        """
+        if isinstance(data, KnownFaces):
+            return data.build_index() if index and data.index is None else data
+        names = []
+        name_ids = {}
+        labels = []
+        # label ids are assigned in order of first appearance
+        for name in data['names']:
+            if name not in name_ids:
+                name_ids[name] = len(names)
+                names.append(name)
+            labels.append(name_ids[name])
+        encodings = np.asarray(data['encodings'], dtype=np.float32).reshape(len(labels), -1)
+        known_faces = KnownFaces(encodings, labels, names)
+        return known_faces.build_index() if index else known_faces
+
+    def __len__(self):
+        return len(self.labels)
+
+    def distances(self, encodings, candidates=None):
+        """ Computes the euclidean distance between each of the given encodings and the known encodings
+
+        :param encodings: (m, 128) matrix of encodings to match
+        :param candidates: optional indexes of the known encodings to compare against, defaults to all of them
+        :return: (m, n) distance matrix
+        """
+        encodings = np.asarray(encodings, dtype=np.float32)
+        known = self.encodings if candidates is None else self.encodings[candidates]
+        known_norms = self.squared_norms if candidates is None else self.squared_norms[candidates]
+        squared = np.einsum('ij,ij->i', encodings, encodings, dtype=np.float64)[:, np.newaxis] \
+            + known_norms[np.newaxis, :] \
+            - 2.0 * (encodings @ known.T)
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def match(self, encodings, tolerance=DEFAULT_TOLERANCE):
+        """ Names each encoding after the known name with the most encodings within tolerance, ties are won by the
+        name whose matching encoding comes first (as in the original compare_faces vote)
+
+        :param encodings: list or (m, 128) matrix of encodings to match
+        :param tolerance: maximum distance between two encodings of the same face
+        :return: list of m names, 'Unknown' for encodings that match none of the known encodings
+        """
+        if len(encodings) == 0:
+            return []
+        if len(self.labels) == 0:
+            return [KnownFaces.NAME_UNKNOWN] * len(encodings)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1)
+        if self.index is None:
+            rows, cols = np.nonzero(self._within(encodings, tolerance))
+        else:
+            rows, cols = self._match_indexed(encodings, tolerance)
+        return self._vote(len(encodings), rows, cols)
+
+    def _match_indexed(self, encodings, tolerance):
+        rows = [np.zeros(0, dtype=np.int64)]
+        cols = [np.zeros(0, dtype=np.int64)]
+        for row, candidates in enumerate(self.index.candidates(encodings, tolerance)):
+            if len(candidates) == 0:
+                continue
+            matched = candidates[self._within(encodings[row:row + 1], tolerance, candidates)[0]]
+            rows.append(np.full(len(matched), row, dtype=np.int64))
+            cols.append(matched)
+        return np.concatenate(rows), np.concatenate(cols)
+
+    def _within(self, encodings, tolerance, candidates=None):
+        """ (m, n) mask of the known encodings within tolerance of each encoding, deciding as face_distance would
+
+        :param candidates: optional indexes of the known encodings to compare against, defaults to all of them
+        """
+        distances = self.distances(encodings, candidates)
+        within = distances <= tolerance
+        # the expanded form is not bit-identical to the norm of the difference, re-check the borderline pairs with it
+        rows, cols = np.nonzero(np.abs(distances - tolerance) <= KnownFaces.EXACT_MARGIN)
+        if len(rows):
+            known = self.encodings[cols] if candidates is None else self.encodings[np.asarray(candidates)[cols]]
+            exact = np.linalg.norm(encodings[rows].astype(np.float64) - known.astype(np.float64), axis=1)
+            within[rows, cols] = exact <= tolerance
+        return within
+
+    def nearest(self, encoding, k=1):
+        """ Finds the k known encodings nearest to the given encoding
+
+        :return: list of (name, distance) tuples, closest first
+        """
+        if self.index is None:
+            distances = self.distances(np.asarray(encoding, dtype=np.float32).reshape(1, -1))[0]
+            indexes = np.argsort(distances, kind='stable')[:k]
+            distances = distances[indexes]
+        else:
+            indexes, distances = self.index.nearest(encoding, k)
+        return [(self.names[self.labels[i]], float(d)) for i, d in zip(indexes, distances)]
+
+    def _vote(self, m, rows, cols):
+        """ Tallies the matches (rows[i] matched known encoding cols[i]) of m encodings by name """
+        n, k = len(self.labels), len(self.names)
+        labels = self.labels[cols]
+        counts = np.zeros((m, k), dtype=np.int64)
+        np.add.at(counts, (rows, labels), 1)
+        first_match = np.full((m, k), n, dtype=np.int64)
+        np.minimum.at(first_match, (rows, labels), cols)
+        # most votes first, earliest match breaks ties
+        score = counts * (n + 1) - first_match
+        winners = np.argmax(score, axis=1)
+        matched = counts.max(axis=1) > 0
+        return [self.names[label] if ok else KnownFaces.NAME_UNKNOWN for label, ok in zip(winners, matched)]
+
+    def save(self, store_path):
+        """ Writes the encodings store as a new version and points store_path at it, replacing any existing store
+
+        :param store_path: path of the store (a symlink to the current version directory)
+        """
+        parent = os.path.dirname(os.path.abspath(store_path))
+        os.makedirs(parent, exist_ok=True)
+        prefix = os.path.basename(os.path.normpath(store_path)) + VERSION_INFIX
+        version_path = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        with open(os.path.join(version_path, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump({'format': STORE_FORMAT, 'version': STORE_VERSION, 'names': self.names}, f, ensure_ascii=False)
+        np.save(os.path.join(version_path, 'encodings.npy'), np.ascontiguousarray(self.encodings, dtype=np.float32))
+        np.save(os.path.join(version_path, 'name_ids.npy'), np.ascontiguousarray(self.labels, dtype=np.int32))
+        np.save(os.path.join(version_path, 'squared_norms.npy'), np.ascontiguousarray(self.squared_norms))
+        previous_path = os.path.realpath(store_path) if os.path.islink(store_path) else None
+        if os.path.isdir(store_path) and previous_path is None:
+            # a store saved as a plain directory: the only save with a moment without a store at store_path
+            previous_path = tempfile.mkdtemp(prefix=prefix, dir=parent)
+            os.rename(store_path, previous_path)
+        link_path = version_path + '.link'
+        os.symlink(os.path.basename(version_path), link_path)
+        try:
+            os.replace(link_path, store_path)
+        except BaseException as ex:
+            os.remove(link_path)
+            shutil.rmtree(version_path, ignore_errors=True)
+            raise ex
+        # versions older than the previous one have had a whole save to finish loading
+        for entry in os.scandir(parent):
+            if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False) \
+                    and entry.path not in (version_path, previous_path):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        logger.info(f'{len(self)} encodings of {len(self.names)} people saved to {store_path}')
+
+    @classmethod
+    def load(cls, store_path, mmap=True):
+        """ Reads an encodings store written by save()
+
+        :param store_path: path of the store directory
+        :param mmap: memory-map the arrays read-only instead of reading them into memory
+        :return: KnownFaces
+        """
+        # every file is read from the same version, even if a save replaces the store meanwhile
+        store_path = os.path.realpath(store_path)
+        with open(os.path.join(store_path, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+        if meta.get('format') != STORE_FORMAT:
+            raise ValueError(f'{store_path} is not an encodings store')
+        if meta.get('version', 0) > STORE_VERSION:
+            raise ValueError(f'Encodings store version {meta["version"]} is not supported '
+                             f'(latest supported version: {STORE_VERSION})')
+        mmap_mode = 'r' if mmap else None
+        return KnownFaces(np.load(os.path.join(store_path, 'encodings.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(store_path, 'name_ids.npy'), mmap_mode=mmap_mode),
+                          meta['names'],
+                          np.load(os.path.join(store_path, 'squared_norms.npy'), mmap_mode=mmap_mode))
+
+
+def load_known_faces(path, index=False):
+    """ Loads known face encodings from an encodings store, or from a legacy pickle file
+
+    :param path: path of an encodings store directory or of a pickled {"encodings", "names"} dict
+    :param index: whether to build a nearest neighbour index over the encodings
+    :return: KnownFaces
+    """
+    if os.path.isdir(path):
+        return KnownFaces.from_data(KnownFaces.load(path), index=index)
+    with open(path, 'rb') as f:
+        return KnownFaces.from_data(pickle.load(f), index=index)
+
+
+if __name__ == '__main__':
+    import argparse
+    # Converts pickled encodings (e.g. encodings/encodings_28_Jun_20.pickle) into encodings stores
+    ap = argparse.ArgumentParser()
+    ap.add_argument('pickles', nargs='+', help='paths to pickled encodings files to convert')
+    ap.add_argument('-o', '--output', type=str, default=None,
+                    help='output directory for the stores, defaults to the directory of each pickle')
+    args = vars(ap.parse_args())
+
+    for pickle_path in args['pickles']:
+        out_dir = args['output'] or os.path.dirname(pickle_path)
+        store_path = os.path.join(out_dir, os.path.splitext(os.path.basename(pickle_path))[0])
+        logger.info(f'Converting {pickle_path} to {store_path}')
+        load_known_faces(pickle_path).save(store_path)
@@ -1,6 +1,9 @@
 import subprocess
 import os
+import threading
 import cv2
+import ffmpeg
+import numpy as np
 import infinitechallenge.model.skull_detection as sd
 from infinitechallenge.utils.labelling import label_image
 from tempfile import NamedTemporaryFile
@@ -113,10 +116,12 @@ def calculate_skip_rate(vid, ms_skip_rate):
 
 # returns relevant frames and data (coordinates)
 def process_stream(video_path, azure_key, confidence, model_version, sample_rate=1000, display=False):
-    logger.info(f'Processing {os.path.basename(video_path)} with these settings: Sample rate={sample_rate}ms; Confidence={confidence}; Model Version={model_version}')
+    return list(iter_extracted_frames(video_path, azure_key, confidence, model_version, sample_rate, display))
+
+
+# yields (frame, frame number, millisecond) of every sampled frame of a video file
+def iter_sampled_frames(video_path, sample_rate=1000):
     vid_cap = cv2.VideoCapture(video_path)
-    # initialize output list
-    extracted_frames = []
     # processing parameters
     frame_skip_rate = calculate_skip_rate(vid_cap, sample_rate)
     while vid_cap.isOpened():
@@ -129,7 +134,71 @@ def process_stream(video_path, azure_key, confidence, model_version, sample_rate
         millisecond = int(vid_cap.get(cv2.CAP_PROP_POS_MSEC))
         if frame_number % frame_skip_rate != 0:
             continue
-
+        yield frame, frame_number, millisecond
+    vid_cap.release()
+
+
+def probe_video(path):
+    """ (width, height, fps) of the first video stream, only needs the header of the file """
+    info = ffmpeg.probe(path)
+    stream = next(s for s in info['streams'] if s['codec_type'] == 'video')
+    num, den = stream['avg_frame_rate'].split('/')
+    return int(stream['width']), int(stream['height']), float(num) / float(den)
+
+
+def _feed(reader, pipe, block_size=1 << 20):
+    try:
+        for block in iter(lambda: reader.read(block_size), b''):
+            pipe.write(block)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit status tells why
+        pass
+    except Exception as ex:
+        logger.error(f'Feeding video to ffmpeg failed: {ex}')
+    finally:
+        reader.close()
+        pipe.close()
+
+
+# yields (frame, frame number, millisecond) of every sampled frame of a video read sequentially from reader
+# (e.g. a file that is still downloading), decoded by ffmpeg. Frame numbers and times match iter_sampled_frames.
+def iter_piped_frames(reader, width, height, fps, sample_rate=1000):
+    frame_skip_rate = max(1, int(fps * (sample_rate / 1000)))
+    process = (
+        ffmpeg.input('pipe:')
+        .output('pipe:', format='rawvideo', pix_fmt='bgr24', vsync='0',
+                vf=f'select=not(mod(n+1\\,{frame_skip_rate}))')
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdin=True, pipe_stdout=True)
+    )
+    feeder = threading.Thread(target=_feed, args=(reader, process.stdin), daemon=True)
+    feeder.start()
+    frame_size = width * height * 3
+    frame_number = 0
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                logger.info("No more frames from source stream. Exiting...")
+                break
+            frame_number += frame_skip_rate
+            frame = np.frombuffer(data, np.uint8).reshape((height, width, 3)).copy()
+            yield frame, frame_number, int((frame_number - 1) * 1000 / fps)
+    finally:
+        process.stdout.close()
+        if process.wait() not in (0, None):
+            logger.warning(f'ffmpeg exited with status {process.returncode}')
+        feeder.join()
+
+
+# yields relevant frames and data (coordinates) as soon as each of them is found
+# frames: (frame, frame number, millisecond) source, sampled from video_path if not given
+def iter_extracted_frames(video_path, azure_key, confidence, model_version, sample_rate=1000, display=False,
+                          frames=None):
+    logger.info(f'Processing {os.path.basename(video_path)} with these settings: Sample rate={sample_rate}ms; Confidence={confidence}; Model Version={model_version}')
+    if frames is None:
+        frames = iter_sampled_frames(video_path, sample_rate)
+    for frame, frame_number, millisecond in frames:
         # Time stamping
         timestamp = Timestamp.from_milliseconds(millisecond)
 
@@ -144,17 +213,15 @@ def process_stream(video_path, azure_key, confidence, model_version, sample_rate
                 bottom = int(bottom * resize_factor[0])
                 left = int(left * resize_factor[1])
                 skull_coords.append((top, right, bottom, left))
-            if len(skull_coords) > 0:
-                extracted_frames.append(ExtractedFrame(frame, label_frame(frame, skull_coords),
-                                                       frame_number, timestamp, skull_coords))
         logger.info('[{}] skulls detected: {}'.format(timestamp, skull_coords))
+        if len(skull_coords) > 0:
+            yield ExtractedFrame(frame, label_frame(frame, skull_coords), frame_number, timestamp, skull_coords)
 
         # Display squares on sampled frames where skulls are located
         if display:
             display_sampled_frame(frame, skull_coords)
 
     cv2.destroyAllWindows()
-    return extracted_frames
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import sys
+import time
+import configparser
+import infinitechallenge.logging
+from infinitechallenge.pipeline.phase1 import Phase1
+from infinitechallenge.pipeline.phase2 import Phase2
+from infinitechallenge.pipeline.phase3 import Phase3
+from infinitechallenge.logging import logger
+
+
+# Runs phases 1-3 for an episode in a single process:
+# frames extracted by phase 1 are streamed straight into face recognition (phase 2), and the results are kept in
+# memory for burned member estimation (phase 3). Images and results.csv are only written out (or uploaded) as
+# artefacts, according to the save_*/upload_* options of each phase's config section.
+# It has not been timed against running the phases as separate processes. To compare the two, put the per-stage
+# times logged at the end of each episode next to the elapsed times logged by each phase's run().
+class FusedPipeline:
+    def __init__(self, config, episode_filename):
+        logger.info('Initializing fused pipeline')
+        self.phase1 = Phase1(config['Phase1'], episode_filename)
+        # every phase works on the same in-memory results
+        self.results = self.phase1.results
+        self.phase2 = Phase2(config['Phase2'], episode_filename, results=self.results)
+        self.phase3 = Phase3(config['Phase3'], episode_filename, results=self.results)
+        self.timings = {}
+
+    def extracted_frames(self, episode_filepath=None):
+        phase1 = self.phase1
+        cache_frames = phase1.save_images or phase1.upload_labelled or phase1.upload_unlabelled
+        for frame in phase1.stream(episode_filepath):
+            phase1.update_results([frame])
+            if cache_frames:
+                phase1.cache_extracted_frames([frame])
+            yield frame
+
+    def _timed(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[stage] = time.perf_counter() - start
+        return result
+
+    def run(self, episode_filepath=None):
+        """
+        :param episode_filepath: local copy of the episode, downloaded if not given
+        """
+        try:
+            logger.info('Fused pipeline start')
+            start = time.perf_counter()
+            ep_no = self.phase1.episode_number
+            if episode_filepath is None and not self.phase1.progressive_download:
+                logger.info(f'Downloading episode {ep_no}')
+                episode_filepath = self._timed('download', self.phase1.download_episode)
+
+            logger.info(f'Finding skulls and recognising faces in episode {ep_no}')
+            mappings = self._timed('skulls & faces', self.phase2.process_frames, self.extracted_frames(episode_filepath))
+            self.phase2.update_results(mappings)
+
+            logger.info('Estimating burned members...')
+            self._timed('estimation', self.phase3.process_results)
+            logger.info('Updating database...')
+            self._timed('database', self.phase3.update_database)
+
+            self._timed('artefacts', self.save_artefacts)
+            total = time.perf_counter() - start
+            breakdown = ', '.join(f'{stage} {elapsed:.1f}s' for stage, elapsed in self.timings.items())
+            logger.info(f'Fused pipeline complete for episode {ep_no} in {total:.1f}s ({breakdown})')
+        except Exception as ex:
+            logger.error('Fused pipeline failed')
+            raise ex
+        finally:
+            self.phase2.face_backend.close()
+
+    def save_artefacts(self):
+        for phase in (self.phase1, self.phase2, self.phase3):
+            phase.upload_cached_files()
+            phase.save_cached_files()
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    infinitechallenge.logging.add_file_handler(config['LOG']['logfile_directory'])
+    pipeline = FusedPipeline(config, sys.argv[2])
+    pipeline.run()
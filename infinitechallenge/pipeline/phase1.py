@@ -1,6 +1,7 @@
 import os
 import sys
 import shutil
+import time
 import configparser
 import cv2
 import infinitechallenge.logging
@@ -8,7 +9,8 @@ from tempfile import TemporaryDirectory, NamedTemporaryFile
 from infinitechallenge.pipeline.results import Results
 from infinitechallenge.logging import logger
 from infinitechallenge.model import vid_recognition as vr
-from infinitechallenge.utils.gdrivefile_util import GDrive
+from infinitechallenge.utils.storage import LazyStorage
+from infinitechallenge.utils.progressive import ProgressiveDownload, faststart_header_size
 from infinitechallenge.utils.parsing import get_episode_number_from_filename
 
 
@@ -35,36 +37,76 @@ class Phase1:
         self.upload_unlabelled = config.getboolean('upload_unlabelled')
         self.upload_labelled = config.getboolean('upload_labelled')
         self.upload_results = config.getboolean('upload_results')
+        self.upload_workers = config.getint('upload_workers', fallback=8)
         # for video processing
         self.display = config.getboolean('display')
         self.video_sample_rate = config.getint('video_sample_rate')
         self.skull_confidence_threshold = config.getfloat('skull_confidence_threshold')
         self.skull_model_version = config['skull_model_version']
+        # start decoding while the episode downloads
+        self.progressive_download = config.getboolean('progressive_download', fallback=False)
+        self.download_chunksize = config.getint('download_chunk_mb', fallback=8) * 1024 * 1024
+        self.download_parallelism = config.getint('download_parallelism', fallback=1)
         try:
             self.azure_key = os.environ['IC_AZURE_KEY_SKULL']
         except KeyError as ex:
             logger.error('Missing required environment variable')
             raise ex
-        # for google drive
-        self.gdrive = GDrive(token_path=os.environ['IC_GDRIVE_AUTH_TOKEN_PATH'],
-                             client_secrets_path=os.environ['IC_GDRIVE_CLIENT_SECRETS_PATH'])
+        # for downloading episodes and uploading artefacts
+        self.storage = LazyStorage(config)
 
     def download_episode(self):
         remote_path = os.path.join('episodes', self.episode_filename)
         cached_video_path = os.path.join(self.cache_dir.name, self.episode_filename)
-        self.gdrive.download_file(remote_path, cached_video_path)
+        self.storage.download(remote_path, cached_video_path, self.download_chunksize, self.download_parallelism)
         return cached_video_path
 
     def process_episode(self, episode_filepath):
-        extracted_frames = vr.process_stream(
+        return list(self.stream_episode(episode_filepath))
+
+    def stream_episode(self, episode_filepath, frames=None):
+        return vr.iter_extracted_frames(
             video_path=episode_filepath,
             azure_key=self.azure_key,
             confidence=self.skull_confidence_threshold,
             model_version=self.skull_model_version,
             sample_rate=self.video_sample_rate,
-            display=self.display
+            display=self.display,
+            frames=frames
         )
-        return extracted_frames
+
+    def stream_downloading_episode(self):
+        """ Yields extracted frames while the episode downloads
+
+        Episodes that are not faststart MP4s cannot be decoded from a stream, they are processed once downloaded.
+        """
+        remote_path = os.path.join('episodes', self.episode_filename)
+        cached_video_path = os.path.join(self.cache_dir.name, self.episode_filename)
+        download = ProgressiveDownload(
+            lambda output_path, on_progress: self.storage.download(remote_path, output_path, self.download_chunksize,
+                                                                   on_progress=on_progress),
+            cached_video_path)
+        header_size = faststart_header_size(download)
+        if header_size is None:
+            logger.warning(f'{self.episode_filename} is not a faststart MP4, waiting for the download to complete')
+            yield from self.stream_episode(download.wait())
+            return
+        download.wait_for(header_size)
+        width, height, fps = vr.probe_video(cached_video_path)
+        frames = vr.iter_piped_frames(download.open(), width, height, fps, self.video_sample_rate)
+        yield from self.stream_episode(cached_video_path, frames)
+        # surfaces download errors that ended the stream early
+        download.wait()
+
+    def stream(self, episode_filepath=None):
+        """ Extracted frames of the episode, downloading it first unless a local copy is given """
+        if episode_filepath is not None:
+            return self.stream_episode(episode_filepath)
+        if self.progressive_download:
+            logger.info(f'Streaming episode {self.episode_number}')
+            return self.stream_downloading_episode()
+        logger.info(f'Downloading episode {self.episode_number}')
+        return self.stream_episode(self.download_episode())
 
     def cache_extracted_frames(self, extracted_frames):
         for frame in extracted_frames:
@@ -82,17 +124,20 @@ class Phase1:
     def upload_cached_files(self):
         dir_path = self.cache_dir.name
         dst_dir = f'episode{self.episode_number}_output'
+        paths = []
         for file in os.listdir(dir_path):
             path = os.path.join(dir_path, file)
             if file.endswith('skull.jpg') and self.upload_labelled:
-                self.gdrive.upload_file(path, remote_filepath=os.path.join(dst_dir, file))
+                paths.append(path)
             elif file.endswith('.jpg') and not file.endswith('skull.jpg') and self.upload_unlabelled:
-                self.gdrive.upload_file(path, remote_filepath=os.path.join(dst_dir, file))
+                paths.append(path)
+        if paths:
+            self.storage.upload_many(paths, dst_dir, workers=self.upload_workers)
         if self.upload_results:
             tempfile = NamedTemporaryFile(suffix='.csv')
             self.results.write(tempfile.name)
             tempfile.seek(0)
-            self.gdrive.upload_file(tempfile.name, remote_filepath=os.path.join(dst_dir, 'phase1_results.csv'))
+            self.storage.upload(tempfile.name, os.path.join(dst_dir, 'phase1_results.csv'))
 
     def save_cached_files(self):
         out_dir_path = self.output_directory_path
@@ -108,16 +153,18 @@ class Phase1:
         if self.save_results:
             self.results.write(os.path.join(out_dir_path, 'results.csv'))
 
-    def run(self):
+    def run(self, episode_filepath=None):
+        """
+        :param episode_filepath: local copy of the episode (e.g. prefetched by the scheduler), downloaded from
+            storage if not given
+        """
         try:
             logger.info('Phase 1 start')
+            start = time.perf_counter()
             ep_no = self.episode_number
-            # get episode from google drive
-            logger.info(f'Downloading episode {ep_no} from Google Drive')
-            episode_filepath = self.download_episode()
-            # process episode
+            # process episode, downloaded from storage if no local copy is given
             logger.info(f'Finding frames with skulls in episode {ep_no}')
-            extracted_frames = self.process_episode(episode_filepath)
+            extracted_frames = list(self.stream(episode_filepath))
             # update results and cache image locally on container
             logger.info(f'Caching frames with skulls in episode {ep_no}')
             self.cache_extracted_frames(extracted_frames)
@@ -128,7 +175,7 @@ class Phase1:
             self.upload_cached_files()
             self.save_cached_files()
 
-            logger.info('Phase 1 complete')
+            logger.info(f'Phase 1 complete in {time.perf_counter() - start:.1f}s')
         except Exception as ex:
             logger.error('Phase 1 failed')
             raise ex
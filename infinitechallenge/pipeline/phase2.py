@@ -1,27 +1,37 @@
 import os
 import sys
 import shutil
+import time
 import configparser
+import cv2
 import infinitechallenge.logging
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 from infinitechallenge.model import azure_face_recognition as afr
+from infinitechallenge.model.face_backend import create_face_backend, read_image
 from infinitechallenge.model.vid_recognition import Timestamp
 from infinitechallenge.pipeline.results import Results
 from infinitechallenge.logging import logger
-from infinitechallenge.utils.gdrivefile_util import GDrive
+from infinitechallenge.utils.storage import LazyStorage
 from infinitechallenge.utils.parsing import get_episode_number_from_filename
 
 
 class Phase2:
-    def __init__(self, config, episode_filename):
+    def __init__(self, config, episode_filename, results=None):
+        """
+        :param config: the [Phase2] config section
+        :param episode_filename: episode filename (e.g. episode1.mp4)
+        :param results: results of phase 1, read from the input directory if not given
+        """
         logger.info('Initializing phase 2 parameters')
         self.episode_number = get_episode_number_from_filename(episode_filename)
         # input
         self.input_directory_path = os.path.join(config['input_directory_path'],  f'episode{self.episode_number}')
         # prepare directory for caching
         self.cache_dir = TemporaryDirectory()
-        results_file_path = os.path.join(self.input_directory_path, 'results.csv')
-        self.results = Results.read(results_file_path)
+        if results is None:
+            results_file_path = os.path.join(self.input_directory_path, 'results.csv')
+            results = Results.read(results_file_path)
+        self.results = results
         # prepare directory for local saving
         self.save_images = config.getboolean('save_images')
         self.save_results = config.getboolean('save_results')
@@ -33,26 +43,27 @@ class Phase2:
         # for uploading cached files
         self.upload_labelled = config.getboolean('upload_images')
         self.upload_results = config.getboolean('upload_results')
-        # for google drive
-        self.gdrive = GDrive(token_path=os.environ['IC_GDRIVE_AUTH_TOKEN_PATH'],
-                             client_secrets_path=os.environ['IC_GDRIVE_CLIENT_SECRETS_PATH'])
+        self.upload_workers = config.getint('upload_workers', fallback=8)
+        # for uploading artefacts
+        self.storage = LazyStorage(config)
         # for face recognition
-        self.person_group_id = config['person_group_id']
-        self.faceclient = afr.authenticate_client(config['endpoint'], os.environ['IC_AZURE_KEY_FACE'])
+        self.face_backend = create_face_backend(config)
+        self.face_batch_size = config.getint('face_batch_size', 1)
+        self.face_roi = config.getboolean('face_roi', False)
+        self.face_roi_expansion = config.getfloat('face_roi_expansion', 4.0)
 
     def upload_cached_files(self):
         dir_path = self.cache_dir.name
         dst_dir = f'episode{self.episode_number}_output'
         if self.upload_labelled:
-            for file in os.listdir(dir_path):
-                path = os.path.join(dir_path, file)
-                if file.endswith('face.jpg') and self.upload_labelled:
-                    self.gdrive.upload_file(path, remote_filepath=os.path.join(dst_dir, file))
+            paths = [os.path.join(dir_path, file) for file in os.listdir(dir_path) if file.endswith('face.jpg')]
+            if paths:
+                self.storage.upload_many(paths, dst_dir, workers=self.upload_workers)
         if self.upload_results:
             tempfile = NamedTemporaryFile(suffix='.csv')
             self.results.write(tempfile.name)
             tempfile.seek(0)
-            self.gdrive.upload_file(tempfile.name, remote_filepath=os.path.join(dst_dir, 'phase2_results.csv'))
+            self.storage.upload(tempfile.name, os.path.join(dst_dir, 'phase2_results.csv'))
 
     def save_cached_files(self):
         out_dir_path = self.output_directory_path
@@ -68,23 +79,72 @@ class Phase2:
             self.results.write(os.path.join(out_dir_path, 'results.csv'))
 
     def process_images(self, image_paths):
+        if self.face_roi:
+            return self.process_images_roi(image_paths)
+        mappings = {}
+        for start in range(0, len(image_paths), self.face_batch_size):
+            batch = image_paths[start:start + self.face_batch_size]
+            logger.info(f'Processing {", ".join(os.path.basename(path) for path in batch)}')
+            skull_boxes = [self.get_skull_coords(os.path.basename(path)) for path in batch]
+            for path, faces in zip(batch, self.face_backend.recognise_files(batch, skull_boxes)):
+                self.label_faces(path, faces)
+                mappings[os.path.basename(path)] = faces
+        return mappings
+
+    def process_images_roi(self, image_paths):
         mappings = {}
         for path in image_paths:
-            in_dir_path, filename = os.path.split(path)
-            logger.info(f'Processing {filename}')
-            faces = afr.recognise_faces(self.faceclient, path, self.person_group_id)
+            filename = os.path.basename(path)
+            logger.info(f'Processing {filename} around skulls')
+            faces = self.face_backend.recognise_roi(read_image(path), self.get_skull_coords(filename),
+                                                    self.face_roi_expansion)
+            self.label_faces(path, faces)
             mappings[filename] = faces
-            logger.info(f'Caching labelled images')
-            name, ext = filename.split('.')
-            if faces:
-                face_labelled_image_path = os.path.join(self.cache_dir.name, f'{name}_face.{ext}')
-            else:
-                face_labelled_image_path = os.path.join(self.cache_dir.name, f'{name}_noface.{ext}')
-            skull_labelled_image_path = os.path.join(in_dir_path, f'{name}_skull.{ext}')
-            # overlay face labels over skull labels from previous phase
-            afr.label_image(faces, skull_labelled_image_path, face_labelled_image_path)
         return mappings
 
+    def process_frames(self, extracted_frames):
+        """ Recognises faces in frames extracted by phase 1, without reading them back from disk
+
+        :param extracted_frames: iterable of vid_recognition.ExtractedFrame
+        :return: faces of each frame, by the frame's filename
+        """
+        mappings = {}
+        with TemporaryDirectory() as skull_labelled_dir:
+            for frame in extracted_frames:
+                filename = f"{self.episode_number}_{frame.timestamp.with_delimiter('_')}.jpg"
+                logger.info(f'Processing {filename}')
+                if self.face_roi:
+                    faces = self.face_backend.recognise_roi(frame.frame, frame.coord, self.face_roi_expansion)
+                else:
+                    faces = self.face_backend.recognise_image(frame.frame, frame.coord)
+                mappings[filename] = faces
+                if self.save_images or self.upload_labelled:
+                    path = os.path.join(skull_labelled_dir, filename)
+                    cv2.imwrite(path.replace('.jpg', '_skull.jpg'), frame.labelled_frame)
+                    self.label_faces(path, faces)
+        return mappings
+
+    def label_faces(self, path, faces):
+        in_dir_path, filename = os.path.split(path)
+        logger.info(f'Caching labelled images')
+        name, ext = filename.split('.')
+        if faces:
+            face_labelled_image_path = os.path.join(self.cache_dir.name, f'{name}_face.{ext}')
+        else:
+            face_labelled_image_path = os.path.join(self.cache_dir.name, f'{name}_noface.{ext}')
+        skull_labelled_image_path = os.path.join(in_dir_path, f'{name}_skull.{ext}')
+        # overlay face labels over skull labels from previous phase
+        afr.label_image(faces, skull_labelled_image_path, face_labelled_image_path)
+
+    def get_skull_coords(self, filename):
+        ep, h, m, s, ms = filename.split('.')[0].split('_')
+        try:
+            skull_coords, face_coords, names, burned = self.results.get_entry(int(ep), str(Timestamp(h, m, s, ms)))
+            return skull_coords
+        except KeyError:
+            logger.warning(f'No skull detection results for {filename}')
+            return None
+
     def update_results(self, mappings):
         for filename in mappings:
             faces = mappings[filename]
@@ -105,6 +165,7 @@ class Phase2:
     def run(self):
         try:
             logger.info('Phase 2 start')
+            start = time.perf_counter()
             paths = self.get_imagepaths()
             logger.info('Processing images in input directory')
             results = self.process_images(paths)
@@ -112,10 +173,12 @@ class Phase2:
             self.update_results(results)
             self.upload_cached_files()
             self.save_cached_files()
-            logger.info('Phase 2 complete')
+            logger.info(f'Phase 2 complete in {time.perf_counter() - start:.1f}s')
         except Exception as ex:
             logger.error('Phase 2 failed')
             raise ex
+        finally:
+            self.face_backend.close()
 
 
 if __name__ == '__main__':
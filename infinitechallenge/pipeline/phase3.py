@@ -1,18 +1,34 @@
 import os
 import sys
+import time
 import configparser
+import pandas
 import infinitechallenge.logging
 from tempfile import NamedTemporaryFile
 from infinitechallenge.utils.estimation import estimate_burned_member
-from infinitechallenge.utils.sql_connecter import SqlConnector
+from infinitechallenge.utils.sql_connecter import SqlConnector, DEFAULT_CHUNK_ROWS, DEFAULT_POOL_SIZE
 from infinitechallenge.pipeline.results import Results
 from infinitechallenge.logging import logger
-from infinitechallenge.utils.gdrivefile_util import GDrive
-from infinitechallenge.utils.parsing import get_episode_number_from_filename
+from infinitechallenge.utils.storage import LazyStorage
+from infinitechallenge.utils.parsing import get_episode_number_from_filename, get_time_of_day_from_timestamp
 
 
 class Phase3:
-    def __init__(self, config, episode_filename):
+    # columns of the results table and the types their values are sent as
+    DB_COLUMNS = [Results.FIELDNAME_EP, Results.FIELDNAME_TIME, Results.FIELDNAME_BURNED_MEMBER]
+    DB_TYPES = ['int', 'time(3)', 'nvarchar(100)']
+    # how results are written when the episode already has rows in the table:
+    #   insert  plain inserts, re-running an episode fails on the unique index of its rows (see sql/create_tables.sql)
+    #   replace delete the rows of the episode and insert the results, in one transaction
+    #   upsert  update the rows with the same episode and time, insert the others
+    DB_WRITE_MODES = ['insert', 'replace', 'upsert']
+
+    def __init__(self, config, episode_filename, results=None):
+        """
+        :param config: the [Phase3] config section
+        :param episode_filename: episode filename (e.g. episode1.mp4)
+        :param results: results of phase 2, read from the input directory if not given
+        """
         logger.info('initializing phase3 parameters')
         self.episode_number = get_episode_number_from_filename(episode_filename)
 
@@ -22,16 +38,24 @@ class Phase3:
         self.output_directory_path = os.path.join(config['output_directory_path'], f'episode{self.episode_number}')
         if self.save_results:
             os.makedirs(self.output_directory_path, exist_ok=True)
-        self.results = Results.read(os.path.join(input_directory_path, 'results.csv'))
+        if results is None:
+            results = Results.read(os.path.join(input_directory_path, 'results.csv'))
+        self.results = results
         self.database = SqlConnector(config['db_endpoint'],
                                      config['db_name'],
                                      config['db_username'],
-                                     os.environ['IC_RDS_PASSWORD'])
+                                     os.environ['IC_RDS_PASSWORD'],
+                                     config.getint('db_pool_size', fallback=DEFAULT_POOL_SIZE))
         self.db_tablename = config['db_tablename']
+        self.db_chunk_rows = config.getint('db_chunk_rows', fallback=DEFAULT_CHUNK_ROWS)
+        self.db_staged_insert = config.getboolean('db_staged_insert', fallback=False)
+        self.db_write_mode = config.get('db_write_mode', fallback='replace')
+        if self.db_write_mode not in Phase3.DB_WRITE_MODES:
+            raise ValueError(f'Unknown db_write_mode: {self.db_write_mode}')
         # for uploading
         self.upload_results = config['upload_results']
-        self.gdrive = GDrive(token_path=os.environ['IC_GDRIVE_AUTH_TOKEN_PATH'],
-                             client_secrets_path=os.environ['IC_GDRIVE_CLIENT_SECRETS_PATH'])
+        # for uploading artefacts
+        self.storage = LazyStorage(config)
 
     def upload_cached_files(self):
         remote_dir = f'episode{self.episode_number}_output'
@@ -39,7 +63,7 @@ class Phase3:
             tempfile = NamedTemporaryFile(suffix='.csv')
             self.results.write(tempfile.name)
             tempfile.seek(0)
-            self.gdrive.upload_file(tempfile.name, remote_filepath=os.path.join(remote_dir, 'phase3_results.csv'))
+            self.storage.upload(tempfile.name, os.path.join(remote_dir, 'phase3_results.csv'))
 
     def save_cached_files(self):
         if self.save_results:
@@ -56,20 +80,27 @@ class Phase3:
             else:
                 self.results.update_burned_member(ep, time, 'NO_BURN')
 
+    def database_records(self):
+        members = self.results.data[Results.FIELDNAME_BURNED_MEMBER]
+        for (ep, timestamp), member in members.items():
+            yield int(ep), get_time_of_day_from_timestamp(timestamp), member if not pandas.isna(member) else None
+
     def update_database(self):
-        tempfile = NamedTemporaryFile(suffix='.csv')
-        self.results.write(tempfile.name)
-        tempfile.seek(0)
-        self.database.bulk_insert_csv(tempfile.name, self.db_tablename, [Results.FIELDNAME_EP, Results.FIELDNAME_TIME, Results.FIELDNAME_BURNED_MEMBER])
+        key_cols = Results.INDEX_FIELDS if self.db_write_mode == 'upsert' else None
+        replace_where = {Results.FIELDNAME_EP: int(self.episode_number)} if self.db_write_mode == 'replace' else None
+        self.database.insert_records(self.db_tablename, Phase3.DB_COLUMNS, self.database_records(), Phase3.DB_TYPES,
+                                     self.db_chunk_rows, self.db_staged_insert, key_cols, replace_where)
 
     def run(self):
         try:
+            start = time.perf_counter()
             logger.info('Estimating burned members...')
             self.process_results()
             logger.info('Updating database...')
             self.update_database()
             self.upload_cached_files()
             self.save_cached_files()
+            logger.info(f'Phase 3 complete in {time.perf_counter() - start:.1f}s')
         except Exception as ex:
             logger.error('Phase 3 failed')
             raise ex
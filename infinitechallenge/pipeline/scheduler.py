@@ -0,0 +1,271 @@
+import argparse
+import configparser
+import csv
+import os
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import Process
+import infinitechallenge.logging
+from infinitechallenge.utils.prefetch import Prefetcher
+from infinitechallenge.utils.storage import create_storage
+from infinitechallenge.utils.task_queue import TaskQueue, SqlServerTaskQueue
+from infinitechallenge.logging import logger
+
+# Description: Processes a range of episodes with a single long-lived scheduler
+# Every episode x phase is a task in a durable queue. Tasks are run by a configurable number of worker processes,
+# failed tasks are retried, and completed tasks are skipped when the scheduler is restarted.
+# With queue_backend = sqlserver the queue lives in the project database, and schedulers started on several nodes with
+# the same episode range share the backlog: each task is leased by one worker at a time, and the tasks of a worker
+# that stops sending heartbeats are reassigned once their lease expires. Phases 2 and 3 read the output of the previous
+# phase from the node's own phase directories, so a shared queue requires mode = fused, unless shared_output says that
+# those directories are on storage shared by every node.
+# With prefetch_depth > 0 a worker running a task that downloads its episode also claims the next task(s), so that
+# their episodes download in the background while the current episode is processed.
+
+PHASES = ['phase1', 'phase2', 'phase3']
+FUSED = ['fused']
+# phases that start from the episode video
+DOWNLOAD_PHASES = ['phase1', 'fused']
+
+
+def read_episode_numbers(episode_info_path, first, last):
+    """ Distinct episode numbers (first column of the episode info CSV) between first and last inclusive
+
+    The CSV has one row per segment, so an episode number can appear on several rows.
+    """
+    with open(episode_info_path, encoding='utf8') as f:
+        episodes = [int(row[0]) for row in csv.reader(f) if row and row[0].isdigit()]
+    return sorted({ep for ep in episodes if first <= ep <= last})
+
+
+def run_task(config, episode_filename, phase, episode_filepath=None):
+    # imported here so that the scheduler itself does not need every phase's dependencies
+    if phase == 'phase1':
+        from infinitechallenge.pipeline.phase1 import Phase1
+        Phase1(config['Phase1'], episode_filename).run(episode_filepath)
+    elif phase == 'phase2':
+        from infinitechallenge.pipeline.phase2 import Phase2
+        Phase2(config['Phase2'], episode_filename).run()
+    elif phase == 'phase3':
+        from infinitechallenge.pipeline.phase3 import Phase3
+        Phase3(config['Phase3'], episode_filename).run()
+    elif phase == 'fused':
+        from infinitechallenge.pipeline.fused import FusedPipeline
+        FusedPipeline(config, episode_filename).run(episode_filepath)
+    else:
+        raise ValueError(f'Unknown phase: {phase}')
+
+
+def open_queue(scheduler_config):
+    max_attempts = scheduler_config.getint('max_attempts', 3)
+    lease_seconds = scheduler_config.getfloat('lease_seconds', TaskQueue.DEFAULT_LEASE_SECONDS)
+    if scheduler_config.get('queue_backend', 'sqlite') == 'sqlserver':
+        # imported here so that the SQLite queue does not need pyodbc
+        from infinitechallenge.utils.sql_connecter import build_connection_string
+        connection_string = build_connection_string(scheduler_config['queue_db_endpoint'],
+                                                    scheduler_config['queue_db_name'],
+                                                    scheduler_config['queue_db_username'],
+                                                    os.environ['IC_RDS_PASSWORD'])
+        return SqlServerTaskQueue(connection_string, max_attempts, lease_seconds)
+    return TaskQueue(scheduler_config['queue_path'], max_attempts, lease_seconds)
+
+
+def check_mode(scheduler_config):
+    """ Rejects running phases as separate tasks from a shared queue when their output is local to each node """
+    if scheduler_config.get('mode', 'phases') == 'phases' \
+            and scheduler_config.get('queue_backend', 'sqlite') == 'sqlserver' \
+            and not scheduler_config.getboolean('shared_output', False):
+        raise ValueError('mode = phases with queue_backend = sqlserver lets a node run a phase whose input was written '
+                         'on another node, use mode = fused or set shared_output = true when the phase directories '
+                         'are shared by every node')
+
+
+class Heartbeat(threading.Thread):
+    """ Renews the leases on the tasks held by a worker until stopped, with its own queue connection """
+
+    def __init__(self, scheduler_config):
+        super().__init__(daemon=True)
+        self.scheduler_config = scheduler_config
+        self.interval = scheduler_config.getfloat('heartbeat_interval', 60.0)
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add(self, task):
+        with self.lock:
+            self.tasks.append(task)
+
+    def remove(self, task):
+        with self.lock:
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+    def holds(self, task):
+        # tasks are removed before their lease is released, so a finished task is no longer held
+        with self.lock:
+            return task in self.tasks
+
+    def run(self):
+        queue = open_queue(self.scheduler_config)
+        try:
+            while not self.stopped.wait(self.interval):
+                with self.lock:
+                    tasks = list(self.tasks)
+                for task in tasks:
+                    try:
+                        if not queue.heartbeat(task) and self.holds(task):
+                            logger.warning(f'Lost the lease on {task}, it may have been reassigned to another worker')
+                            self.remove(task)
+                    except Exception as ex:
+                        logger.error(f'Heartbeat for {task} failed: {ex}')
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class EpisodeDownloader:
+    """ Downloads episodes from storage like phase 1 does, with one storage client per thread """
+
+    def __init__(self, phase1_config):
+        self.phase1_config = phase1_config
+        self.chunksize = phase1_config.getint('download_chunk_mb', fallback=8) * 1024 * 1024
+        self.parallelism = phase1_config.getint('download_parallelism', fallback=1)
+        self.local = threading.local()
+
+    def __call__(self, episode_filename, output_path):
+        if not hasattr(self.local, 'storage'):
+            self.local.storage = create_storage(self.phase1_config)
+        self.local.storage.download(os.path.join('episodes', episode_filename), output_path, self.chunksize,
+                                    self.parallelism)
+
+
+def create_prefetcher(config, worker_id):
+    scheduler_config = config['Scheduler']
+    if scheduler_config.getint('prefetch_depth', 0) <= 0:
+        return None
+    directory = os.path.join(scheduler_config['prefetch_directory'], f'worker{worker_id}')
+    budget_bytes = scheduler_config.getint('prefetch_budget_mb', 4096) * 1024 * 1024
+    return Prefetcher(EpisodeDownloader(config['Phase1']), directory, budget_bytes)
+
+
+def worker(config_path, worker_id):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    scheduler_config = config['Scheduler']
+    filename_format = scheduler_config.get('episode_filename_format', 'episode{}.mp4')
+    poll_interval = scheduler_config.getfloat('poll_interval', 10.0)
+    prefetch_depth = scheduler_config.getint('prefetch_depth', 0)
+    queue = open_queue(scheduler_config)
+    prefetcher = create_prefetcher(config, worker_id)
+    heartbeat = Heartbeat(scheduler_config)
+    heartbeat.start()
+    # tasks leased by this worker, in the order they will run
+    claimed = deque()
+
+    def claim():
+        task = queue.claim()
+        if task is not None:
+            claimed.append(task)
+            heartbeat.add(task)
+            if prefetcher is not None and task.phase in DOWNLOAD_PHASES:
+                prefetcher.prefetch(filename_format.format(task.episode_no))
+        return task
+
+    try:
+        while True:
+            if not claimed and claim() is None:
+                if not queue.has_unfinished():
+                    break
+                # the remaining tasks wait for another worker to finish the previous phase
+                time.sleep(poll_interval)
+                continue
+            task = claimed.popleft()
+            episode_filename = filename_format.format(task.episode_no)
+            downloads = prefetcher is not None and task.phase in DOWNLOAD_PHASES
+            if not queue.heartbeat(task):
+                logger.warning(f'[worker {worker_id}] Lease on {task} expired before it could start, skipping it')
+                heartbeat.remove(task)
+                if downloads:
+                    prefetcher.release(episode_filename)
+                continue
+            if downloads:
+                # keep the network busy with the next episodes while this one is processed
+                while len(claimed) < prefetch_depth and claim() is not None:
+                    pass
+            logger.info(f'[worker {worker_id}] Running {task} (attempt {task.attempts})')
+            try:
+                episode_filepath = prefetcher.get(episode_filename) if downloads else None
+                run_task(config, episode_filename, task.phase, episode_filepath)
+                if not heartbeat.holds(task):
+                    # the task was reassigned while it ran, its new owner records the outcome
+                    logger.warning(f'[worker {worker_id}] Lease on {task} was lost while it ran, not completing it')
+                    continue
+                heartbeat.remove(task)
+                # only completes the task if this worker still holds the lease
+                queue.complete(task)
+            except Exception as ex:
+                if not heartbeat.holds(task):
+                    logger.warning(f'[worker {worker_id}] Lease on {task} was lost while it ran, not failing it: {ex}')
+                    continue
+                heartbeat.remove(task)
+                queue.fail(task, ex)
+            finally:
+                if downloads:
+                    prefetcher.release(episode_filename)
+    finally:
+        heartbeat.stop()
+        if prefetcher is not None:
+            prefetcher.close()
+        queue.close()
+        # the connector is only imported by the SQL Server queue and by the phases writing to the database
+        sql_connecter = sys.modules.get('infinitechallenge.utils.sql_connecter')
+        if sql_connecter is not None:
+            sql_connecter.close_pools()
+    logger.info(f'[worker {worker_id}] No more tasks')
+
+
+class Scheduler:
+    def __init__(self, config_path, first, last, retry_failed=False):
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        self.config_path = config_path
+        scheduler_config = config['Scheduler']
+        check_mode(scheduler_config)
+        self.concurrency = scheduler_config.getint('concurrency', 1)
+        self.queue = open_queue(scheduler_config)
+        phases = FUSED if scheduler_config.get('mode', 'phases') == 'fused' else PHASES
+        episodes = read_episode_numbers(scheduler_config['episode_info_path'], first, last)
+        logger.info(f'Scheduling {len(episodes)} episodes ({first}-{last}) x {phases}')
+        if retry_failed:
+            logger.info(f'{self.queue.retry_failed()} failed tasks returned to the queue')
+        self.queue.add(episodes, phases)
+
+    def run(self):
+        start = time.perf_counter()
+        workers = [Process(target=worker, args=(self.config_path, i)) for i in range(self.concurrency)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        logger.info(f'Scheduler finished in {time.perf_counter() - start:.1f}s: {self.queue.summary()}')
+        self.queue.close()
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('config', help='path to config file')
+    ap.add_argument('first', type=int, help='first episode number to process')
+    ap.add_argument('last', type=int, help='last episode number to process')
+    ap.add_argument('--retry-failed', action='store_true', help='retry tasks that ran out of attempts in earlier runs')
+    args = vars(ap.parse_args())
+
+    config = configparser.ConfigParser()
+    config.read(args['config'])
+    infinitechallenge.logging.add_file_handler(config['LOG']['logfile_directory'])
+    scheduler = Scheduler(args['config'], args['first'], args['last'], args['retry_failed'])
+    scheduler.run()
@@ -0,0 +1,85 @@
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import time
+import pandas as pd
+from tempfile import TemporaryDirectory
+from infinitechallenge.logging import logger
+from infinitechallenge.utils.insert_benchmark import StandInCursor
+from infinitechallenge.utils.sql_connecter import SqlConnector, NO_BURN
+
+# Description: Benchmarks the burn statistics queries of SqlConnector on a synthetic skull table
+# The table is filled with random skulls over the real episode list in an SQLite stand-in for SQL Server and every
+# query is timed before and after adding the indexes of sql/create_tables.sql. SQLite indexes carry the rowid rather
+# than the clustered index columns, so these are added to the member index explicitly.
+
+MEMBERS = ['유재석', '박명수', '정준하', '정형돈', '노홍철', '하하', '길', '광희', '양세형', '조세호']
+INDEXES = ['create unique index skull_episode_time_uindex on skull (episode_no, time_appeared)',
+           'create index skull_member_index on skull (member, episode_no, time_appeared)']
+
+
+def synthetic_skulls(episode_numbers, rows, seed=0):
+    """ rows random (episode_no, time_appeared, member), unique by episode and time, a third burning nobody """
+    rng = random.Random(seed)
+    per_episode = -(-rows // len(episode_numbers))
+    for i in range(rows):
+        ep = episode_numbers[i // per_episode]
+        # spread the skulls of an episode over 90 minutes
+        ms = (i % per_episode) * (90 * 60 * 1000 // per_episode)
+        member = NO_BURN if rng.random() < 1 / 3 else rng.choice(MEMBERS)
+        yield ep, datetime.time(ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000 * 1000), member
+
+
+def time_query(query, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = query()
+        best = min(best, time.perf_counter() - start)
+    return best, len(results)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--rows', type=int, default=1000000, help='rows of the synthetic skull table')
+    ap.add_argument('-e', '--episode-info', default='resources/episode_info/Infinite_Challenge_dbo_Episode.csv',
+                    help='episode list with air dates')
+    ap.add_argument('-r', '--repeat', type=int, default=3, help='runs of each query, the best is reported')
+    args = vars(ap.parse_args())
+
+    # one line per segment of an episode
+    episodes = pd.read_csv(args['episode_info'], header=None,
+                           names=['epNo', 'airDate', 'synopsis', 'guestNote']).drop_duplicates('epNo')
+    sqlite3.register_adapter(datetime.time, datetime.time.isoformat)
+    with TemporaryDirectory() as tmp:
+        database = SqlConnector.__new__(SqlConnector)
+        database.conn = sqlite3.connect(os.path.join(tmp, 'benchmark.sqlite'))
+        database.conn.execute('create table episode (id integer primary key, epNo int unique not null, airDate date, '
+                              'synopsis varchar(100), guestNote varchar(100))')
+        database.conn.execute('create table skull (id integer primary key, member nvarchar(100) not null, '
+                              'time_appeared time not null, episode_no int not null references episode (epNo))')
+        database.cursor = StandInCursor(database.conn.cursor(), 0)
+        database.insert_records('episode', ['epNo', 'airDate'], episodes, ['int', 'date'])
+        start = time.perf_counter()
+        database.insert_records('skull', ['episode_no', 'time_appeared', 'member'],
+                                synthetic_skulls(episodes['epNo'].tolist(), args['rows']),
+                                ['int', 'time(3)', 'nvarchar(100)'])
+        logger.info(f'Inserted {args["rows"]} skulls in {time.perf_counter() - start:.1f}s')
+
+        queries = {'burns of one member': lambda: database.member_burns(MEMBERS[0]),
+                   'burns by member': lambda: database.burn_counts(['member']),
+                   'burns by episode': lambda: database.burn_counts(['episode']),
+                   'burns by year': lambda: database.burn_counts(['year']),
+                   'burns of one member by year': lambda: database.burn_counts(['year'], member=MEMBERS[0])}
+        before = {name: time_query(query, args['repeat']) for name, query in queries.items()}
+        start = time.perf_counter()
+        for index in INDEXES:
+            database.conn.execute(index)
+        logger.info(f'Created indexes in {time.perf_counter() - start:.1f}s')
+        after = {name: time_query(query, args['repeat']) for name, query in queries.items()}
+        for name in queries:
+            logger.info(f'{name}: {before[name][0] * 1000:.0f}ms without indexes, {after[name][0] * 1000:.0f}ms with '
+                        f'({after[name][1]} rows)')
+        database.conn.close()
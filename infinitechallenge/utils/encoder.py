@@ -7,7 +7,7 @@ import argparse
 
 def convert_avi_to_mp4(avi_file_path, output_name):
     os.popen("ffmpeg -i '{input}' -ac 2 -b:v 2000k -c:a aac -c:v libx264 -b:a 160k -vprofile high -bf 0 -strict "
-             "experimental -f mp4 '{output}.mp4'".format(input = avi_file_path, output = output_name))
+             "experimental -movflags +faststart -f mp4 '{output}.mp4'".format(input = avi_file_path, output = output_name))
     return True
 
 
@@ -32,4 +32,5 @@ if __name__ == '__main__':
 
         if video_path.endswith('.mp4'):
             vidstream = ffmpeg.input(path.join(vid_dir_path, video_path)).video
-            ffmpeg.output(vidstream, path.join(vid_out_dir_path, video_path), vcodec='libx265', crf=30).overwrite_output().run()
\ No newline at end of file
+            ffmpeg.output(vidstream, path.join(vid_out_dir_path, video_path), vcodec='libx265', crf=30,
+                          movflags='+faststart').overwrite_output().run()
\ No newline at end of file
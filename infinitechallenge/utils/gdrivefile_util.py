@@ -1,13 +1,23 @@
+import fcntl
+import json
 import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from mimetypes import guess_type
 from pickle import dump as p_dump, load as p_load
 from io import FileIO
 from infinitechallenge.logging import logger
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from google.auth.transport.requests import Request, AuthorizedSession
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload, DEFAULT_CHUNK_SIZE
+from infinitechallenge.utils.ranged_download import RangedDownloader, file_md5
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = [
@@ -28,11 +38,32 @@ class DuplicateError(Exception):
 
 
 class GDrive:
-    def __init__(self, credentials: Credentials = None, token_path=None, client_secrets_path=None):
+    # Folder and file ids are cached for the session: a folder's files are listed once, on the first lookup in it, and
+    # the cache is kept up to date with the folders and files this instance creates. Files created in a cached folder
+    # by anyone else are not seen until clear_cache() is called.
+    # Files larger than upload_chunksize are uploaded in resumable chunks. Requests that fail with 5xx/429 or a
+    # connection error are retried with exponential backoff, and the session URI of every unfinished upload is kept in
+    # upload_sessions_path (guarded by a file lock), keyed on the target file, size and MD5 of the content, so that
+    # uploading the same content again continues from the last byte Drive acknowledged, even from another process or
+    # another local copy. A persisted session is resumed with the public resumable upload protocol rather than through
+    # the internals of googleapiclient. Drive keeps upload sessions for a week.
+    DUPLICATE = object()
+    UPLOAD_SESSION_LIFETIME = 6 * 24 * 60 * 60
+
+    def __init__(self, credentials: Credentials = None, token_path=None, client_secrets_path=None,
+                 upload_chunksize=8 * 1024 * 1024, num_retries=5, upload_sessions_path=None):
         self.credentials = credentials
         self.token_path = token_path
         self.client_secrets_path = client_secrets_path
+        self.upload_chunksize = upload_chunksize
+        self.num_retries = num_retries
+        self.upload_sessions_path = upload_sessions_path
+        self.session_lock = threading.Lock()
         self.drive = None
+        # folder name -> folder id, and folder id -> {file name -> file id} for folders that have been listed
+        self.folder_ids = {}
+        self.folder_files = {}
+        self.cache_lock = threading.RLock()
         authentication_methods = [
             self.authenticate_by_token,
             self.authenticate_by_auth_flow
@@ -92,9 +123,40 @@ class GDrive:
             return True
         return False
 
+    def clear_cache(self):
+        with self.cache_lock:
+            self.folder_ids = {}
+            self.folder_files = {}
+
+    def _list_folder(self, folder_id):
+        """
+        Lists the files in a folder into the cache, with a single paged query
+
+        :return: {file name -> file id} of the folder
+        """
+        with self.cache_lock:
+            if folder_id in self.folder_files:
+                return self.folder_files[folder_id]
+            logger.debug(f'listing files in folder {folder_id}')
+            files = {}
+            page_token = None
+            while True:
+                response = self.drive.files().list(q=f"'{folder_id}' in parents and trashed = false",
+                                                   spaces='drive',
+                                                   fields='nextPageToken, files(id, name)',
+                                                   pageSize=1000,
+                                                   pageToken=page_token).execute()
+                for file in response.get('files', []):
+                    files[file['name']] = GDrive.DUPLICATE if file['name'] in files else file['id']
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    break
+            self.folder_files[folder_id] = files
+            return files
+
     def _get_file_id(self, remote_filepath, folder_id=None):
         """
-        Gets the fileId of the first file matching the file name specified
+        Gets the fileId of the file matching the file name specified
 
         :param remote_filepath: path of the file in the drive whose fileId is to be retrieved
         :return: file_id of the file if it exists
@@ -103,27 +165,30 @@ class GDrive:
         if not folder_id:
             folder_id = self._get_folder_id(folder_name)
         logger.debug(f'searching for {file_name} in {folder_name}')
-        page_token = None
-        matches = []
-        while True:
-            response = self.drive.files().list(q=f"name='{file_name}' and '{folder_id}' in parents and trashed = false",
-                                               spaces='drive',
-                                               fields='nextPageToken, files(id, name, parents)',
-                                               pageToken=page_token).execute()
-            results = response.get('files', [])
-            matches += results
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-            logger.debug(f'{file_name} not found, searching in next page...')
-        if len(matches) > 1:
+        file_id = self._list_folder(folder_id).get(file_name)
+        if file_id is GDrive.DUPLICATE:
             logger.critical(f'Duplicates of {remote_filepath} found. File paths should be unique')
             raise DuplicateError('File paths should be unique')
-        elif len(matches) == 1:
-            return matches[0]['id']
+        elif file_id is not None:
+            return file_id
         else:
             raise FileNotFoundError(f'{folder_name}/{file_name} does not exist')
 
+    def list_folder(self, folder_name):
+        """ Names of the files in folder_name, empty if it does not exist """
+        try:
+            folder_id = self._get_folder_id(folder_name)
+        except FileNotFoundError:
+            return []
+        return sorted(self._list_folder(folder_id))
+
+    def exists(self, remote_filepath):
+        try:
+            self._get_file_id(remote_filepath)
+            return True
+        except FileNotFoundError:
+            return False
+
     def list_files(self, page_size=10):
         """
         Lists the first {page_size} files in the drive
@@ -141,24 +206,43 @@ class GDrive:
             for item in items:
                 logger.info(u'{0} ({1} || {2})'.format(item['name'], item['mimeType'], item['id']))
 
-    def download_file(self, remote_filepath, output_path):
+    def download_file(self, remote_filepath, output_path, chunksize=DEFAULT_CHUNK_SIZE, on_progress=None,
+                      parallelism=1):
         """Attempts to download the specified file to the specified output path
 
         :param remote_filepath: Filepath of the file in the drive to be downloaded
         :param output_path: Destination where the downloaded file will be saved
+        :param chunksize: Number of bytes requested at a time
+        :param on_progress: Called with the number of bytes written to output_path after every chunk, which allows
+            the file to be read while it downloads
+        :param parallelism: Number of chunks downloaded at the same time. Above 1 the file is downloaded as concurrent
+            byte ranges and verified against its MD5 checksum (on_progress is then not supported)
         """
         folder_name, file_name = os.path.split(remote_filepath)
         file_id = self._get_file_id(remote_filepath)
+        if parallelism > 1 and on_progress is None:
+            self._download_ranged(file_id, output_path, chunksize, parallelism)
+            logger.info(f'Downloading {file_name}[{file_id}] completed.')
+            return
         request = self.drive.files().get_media(fileId=file_id)
-        fh = FileIO(output_path, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            if done:
-                logger.info(f'Downloading {file_name}[{file_id}] completed.')
-            else:
-                logger.info(f"Downloading {file_name}[{file_id}] {str(int(status.progress() * 100))}%")
+        with FileIO(output_path, 'wb') as fh:
+            downloader = MediaIoBaseDownload(fh, request, chunksize=chunksize)
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+                if on_progress is not None:
+                    on_progress(status.resumable_progress)
+                if done:
+                    logger.info(f'Downloading {file_name}[{file_id}] completed.')
+                else:
+                    logger.info(f"Downloading {file_name}[{file_id}] {str(int(status.progress() * 100))}%")
+
+    def _download_ranged(self, file_id, output_path, chunksize, parallelism):
+        metadata = self.drive.files().get(fileId=file_id, fields='size, md5Checksum').execute()
+        url = f'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media'
+        # one authorized session per download thread, as the client used by self.drive is not thread-safe
+        downloader = RangedDownloader(lambda: AuthorizedSession(self.credentials), chunksize, parallelism)
+        downloader.download(url, output_path, int(metadata['size']), metadata.get('md5Checksum'))
 
     def mkdir(self, folder_name):
         """ Makes a directory as specified by folder_name if the directory does not exist.
@@ -166,17 +250,22 @@ class GDrive:
         :param folder_name: absolute path of the directory to be created
         :return: folder id of the directory created, or existing directory if one already exists with the same name
         """
-        try:
-            id = self._get_folder_id(folder_name)
-            logger.warning('Folder already exists')
-            return id
-        except FileNotFoundError:
-            metadata = {
-                "mimeType": "application/vnd.google-apps.folder",
-                "name": folder_name
-            }
-            folder = self.drive.files().create(body=metadata, fields='id').execute()
-            return folder['id']
+        # the lookup, the create and the cache write are one step, so that threads cannot both create the folder
+        with self.cache_lock:
+            try:
+                id = self._get_folder_id(folder_name)
+                logger.warning('Folder already exists')
+                return id
+            except FileNotFoundError:
+                metadata = {
+                    "mimeType": "application/vnd.google-apps.folder",
+                    "name": folder_name
+                }
+                folder = self.drive.files().create(body=metadata, fields='id').execute()
+                self.folder_ids[folder_name] = folder['id']
+                # a new folder is empty, no need to list it
+                self.folder_files[folder['id']] = {}
+                return folder['id']
 
     def _get_folder_id(self, folder_name):
         """ Retrieves the folder id of the specified folder
@@ -186,32 +275,36 @@ class GDrive:
         """
         if not folder_name or folder_name == 'root':
             return 'root'
-        # Search for folder id in Drive
-        page_token = None
-        folders = []
-        while True:
-            response = self.drive.files().list(
-                q=f"trashed = false and mimeType='application/vnd.google-apps.folder' and name='{folder_name}'",
-                spaces='drive',
-                fields='nextPageToken, files(id, name)',
-                pageToken=page_token).execute()
-            for folder in response.get('files', []):
-                folders.append(folder)
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-
-        if not folders:
-            logger.debug(f'Unable to find folder named{folder_name}')
-            raise FileNotFoundError(f'{folder_name} does not exist')
-
-        elif len(folders) != 1:
-            raise DuplicateError(f'Multiple folders with the name \'{folder_name}\' found. '
-                                 f'Folder names should be unique.')
-
-        folder = folders[0]
-        logger.debug(f'{folder["name"]}[{folder["id"]}]')
-        return folder["id"]
+        with self.cache_lock:
+            if folder_name in self.folder_ids:
+                return self.folder_ids[folder_name]
+            # Search for folder id in Drive
+            page_token = None
+            folders = []
+            while True:
+                response = self.drive.files().list(
+                    q=f"trashed = false and mimeType='application/vnd.google-apps.folder' and name='{folder_name}'",
+                    spaces='drive',
+                    fields='nextPageToken, files(id, name)',
+                    pageToken=page_token).execute()
+                for folder in response.get('files', []):
+                    folders.append(folder)
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    break
+
+            if not folders:
+                logger.debug(f'Unable to find folder named{folder_name}')
+                raise FileNotFoundError(f'{folder_name} does not exist')
+
+            elif len(folders) != 1:
+                raise DuplicateError(f'Multiple folders with the name \'{folder_name}\' found. '
+                                     f'Folder names should be unique.')
+
+            folder = folders[0]
+            logger.debug(f'{folder["name"]}[{folder["id"]}]')
+            self.folder_ids[folder_name] = folder["id"]
+            return folder["id"]
 
     def upload_file(self, filepath, remote_filepath=None):
         """ Uploads a file located at the specified filepath to the remote_filepath specified. If no remote_filepath is
@@ -226,35 +319,207 @@ class GDrive:
             folder_name = 'root'
         else:
             folder_name, filename = os.path.split(remote_filepath)
+        folder_id = self._get_or_create_folder(folder_name)
+        return self._upload(filepath, folder_name, filename, folder_id)
+
+    def upload_many(self, filepaths, remote_dir, workers=8):
+        """ Uploads local files into remote_dir (keeping their file names) through a pool of threads
+
+        :param filepaths: paths of the local files to be uploaded
+        :param remote_dir: folder on the drive where the files are to be uploaded, created if it does not exist
+        :param workers: number of files uploaded at the same time
+        :return: list of the uploaded files' metadata, in the order of filepaths
+        """
+        if not filepaths:
+            return []
+        # resolved once up front, so the uploads only look up the cache
+        folder_id = self._get_or_create_folder(remote_dir)
+        self._list_folder(folder_id)
+        # httplib2 is not thread-safe, every thread sends its requests through its own authorized client
+        local = threading.local()
+
+        def upload(filepath):
+            if not hasattr(local, 'http'):
+                local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+            return self._upload(filepath, remote_dir, os.path.basename(filepath), folder_id, http=local.http)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            files = list(executor.map(upload, filepaths))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        size_mb = sum(os.path.getsize(path) for path in filepaths) / (1024 * 1024)
+        logger.info(f'Uploaded {len(filepaths)} files ({size_mb:.1f}MB) to {remote_dir} in {elapsed:.1f}s '
+                    f'({len(filepaths) / elapsed:.1f} files/s, {size_mb / elapsed:.2f}MB/s, {workers} workers)')
+        return files
+
+    def _get_or_create_folder(self, folder_name):
+        with self.cache_lock:
+            try:
+                return self._get_folder_id(folder_name)
+            except FileNotFoundError:
+                logger.info(f'Target folder [{folder_name}] not found, creating directory')
+                return self.mkdir(folder_name)
+
+    def _upload(self, filepath, folder_name, filename, folder_id, http=None):
+        """ Creates or overwrites filename in the folder, with requests sent through http if given """
         logger.info(f'Uploading {filename}')
-        try:
-            folder_id = self._get_folder_id(folder_name)
-        except FileNotFoundError:
-            logger.info(f'Target folder [{folder_name}] not found, creating directory')
-            folder_id = self.mkdir(folder_name)
         file_metadata = {'name': [filename], 'parents': [folder_id]}
 
-        media = MediaFileUpload(filepath, mimetype=guess_type(filepath)[0])
+        resumable = os.path.getsize(filepath) > self.upload_chunksize
+        media = MediaFileUpload(filepath, mimetype=guess_type(filepath)[0], chunksize=self.upload_chunksize,
+                                resumable=resumable)
         response_fields = 'id, name, parents'
+        session_key = f'{folder_id}/{filename}'
         try:
             # attempt to update file if one with the same name exists
-            file_id = self._get_file_id(remote_filepath, folder_id=folder_id)
-            # if FileNotFoundError was not raised
-
-            metadata = self.drive.files().get(fileId=file_id).execute()
-            del metadata['id']
-            file = self.drive.files().update(fileId=file_id,
-                                             body=metadata,
-                                             media_body=media,
-                                             fields=response_fields).execute()
+            file_id = self._get_file_id(os.path.join(folder_name, filename), folder_id=folder_id)
+            # if FileNotFoundError was not raised, only the content changes
+            request = self.drive.files().update(fileId=file_id,
+                                                body={},
+                                                media_body=media,
+                                                fields=response_fields)
+            file = self._execute_upload(request, filepath, session_key, http)
             logger.info(f"[{file['name']}] already exists and was overwritten")
         except FileNotFoundError:
-            file = self.drive.files().create(body=file_metadata,
-                                             media_body=media,
-                                             fields=response_fields).execute()
+            request = self.drive.files().create(body=file_metadata,
+                                                media_body=media,
+                                                fields=response_fields)
+            file = self._execute_upload(request, filepath, session_key, http)
+            with self.cache_lock:
+                self._list_folder(folder_id)[filename] = file['id']
             logger.info(f"[{file['name']}] was uploaded to {folder_name}")
         return file
 
+    def _execute_upload(self, request, filepath, session_key, http=None):
+        """ Sends an upload request, chunk by chunk for resumable uploads, resuming a persisted session if there is one
+
+        :param session_key: folder_id/filename the file is uploaded to
+        :return: metadata of the uploaded file
+        """
+        if not request.resumable:
+            return request.execute(http=http, num_retries=self.num_retries)
+        # the same content uploaded to the same file resumes the session, wherever the local copy is
+        key = f'{session_key}|{os.path.getsize(filepath)}|{file_md5(filepath)}'
+        uri = self._load_upload_session(key)
+        if uri is not None:
+            logger.info(f'Resuming upload of {filepath}')
+            response = self._resume_upload(uri, filepath, http or request.http)
+            if response is not None:
+                self._save_upload_session(key, None)
+                return response
+            logger.warning(f'Upload session of {filepath} expired, starting over')
+            self._save_upload_session(key, None)
+        response = None
+        while response is None:
+            status, response = request.next_chunk(http=http, num_retries=self.num_retries)
+            if status is not None:
+                if uri != request.resumable_uri:
+                    uri = request.resumable_uri
+                    self._save_upload_session(key, uri)
+                logger.debug(f'Uploading {filepath} {int(status.progress() * 100)}%')
+        self._save_upload_session(key, None)
+        return response
+
+    def _resume_upload(self, uri, filepath, http):
+        """ Sends the rest of filepath to the upload session at uri, with the resumable upload protocol of Drive: a PUT
+        with "Content-Range: bytes */size" asks for the acknowledged bytes, each chunk is then sent with its range
+
+        :return: metadata of the uploaded file, or None if the session has expired
+        """
+        size = os.path.getsize(filepath)
+        retries = 0
+        offset = None
+        with open(filepath, 'rb') as f:
+            while True:
+                if offset is None:
+                    # (re)asks where the session is at, on resuming and after a failed chunk
+                    headers = {'Content-Range': f'bytes */{size}', 'Content-Length': '0'}
+                    body = b''
+                else:
+                    f.seek(offset)
+                    body = f.read(self.upload_chunksize)
+                    headers = {'Content-Range': f'bytes {offset}-{offset + len(body) - 1}/{size}',
+                               'Content-Length': str(len(body))}
+                try:
+                    resp, content = http.request(uri, method='PUT', body=body, headers=headers)
+                except (ConnectionError, httplib2.HttpLib2Error) as ex:
+                    resp, content = None, ex
+                if resp is not None and resp.status in (200, 201):
+                    return json.loads(content)
+                if resp is not None and resp.status == 308:
+                    retries = 0
+                    # "Range: bytes=0-{last}" once Drive has part of the file, no header before the first byte
+                    acknowledged = resp.get('range')
+                    offset = int(acknowledged.rsplit('-', 1)[1]) + 1 if acknowledged else 0
+                    logger.debug(f'Uploading {filepath} {int(offset / size * 100)}%')
+                    continue
+                if resp is not None and resp.status in (404, 410):
+                    return None
+                if resp is not None and resp.status < 500 and resp.status != 429:
+                    raise HttpError(resp, content, uri=uri)
+                if retries >= self.num_retries:
+                    if resp is None:
+                        raise content
+                    raise HttpError(resp, content, uri=uri)
+                retries += 1
+                time.sleep(2 ** retries)
+                offset = None
+
+    def _read_upload_sessions(self):
+        try:
+            with open(self.upload_sessions_path, encoding='utf8') as f:
+                sessions = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        now = time.time()
+        return dict((key, session) for key, session in sessions.items()
+                    if now - session['created'] < GDrive.UPLOAD_SESSION_LIFETIME)
+
+    @contextmanager
+    def _locked_upload_sessions(self):
+        """ Holds the thread lock and an exclusive lock on upload_sessions_path.lock, shared with other processes """
+        with self.session_lock, open(self.upload_sessions_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_upload_session(self, key):
+        if self.upload_sessions_path is None:
+            return None
+        with self._locked_upload_sessions():
+            session = self._read_upload_sessions().get(key)
+        return session['uri'] if session else None
+
+    def _save_upload_session(self, key, uri):
+        """ Records the session URI of an unfinished upload, or forgets it if uri is None """
+        if self.upload_sessions_path is None:
+            return
+        with self._locked_upload_sessions():
+            sessions = self._read_upload_sessions()
+            if uri is None:
+                if sessions.pop(key, None) is None:
+                    return
+            else:
+                sessions[key] = {'uri': uri, 'created': time.time()}
+            temp_path = f'{self.upload_sessions_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf8') as f:
+                json.dump(sessions, f)
+            os.replace(temp_path, self.upload_sessions_path)
+
+
+def create_gdrive(config):
+    """ GDrive authenticated with the token and client secrets given by the IC_GDRIVE_* environment variables
+
+    :param config: config section with the (optional) upload_chunk_mb, upload_retries and upload_sessions_path options
+    """
+    return GDrive(token_path=os.environ['IC_GDRIVE_AUTH_TOKEN_PATH'],
+                  client_secrets_path=os.environ['IC_GDRIVE_CLIENT_SECRETS_PATH'],
+                  upload_chunksize=config.getint('upload_chunk_mb', fallback=8) * 1024 * 1024,
+                  num_retries=config.getint('upload_retries', fallback=5),
+                  upload_sessions_path=config.get('upload_sessions_path', fallback=None))
+
 
 if __name__ == '__main__':
     drive = GDrive(token_path='../../token.pickle', client_secrets_path='../../credentials.json')
@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+import time
+import pandas as pd
+from tempfile import TemporaryDirectory
+from infinitechallenge.logging import logger
+from infinitechallenge.utils.sql_connecter import SqlConnector, DEFAULT_CHUNK_ROWS
+
+# Description: Benchmarks inserting results with SqlConnector into an SQLite stand-in for SQL Server
+# StandInCursor is also used by burn_stats_benchmark.py
+
+
+class StandInCursor:
+    """ sqlite3 cursor behaving like a pyodbc one over a network: every round trip to the server costs latency
+    seconds, executemany makes one round trip per row unless fast_executemany is set """
+
+    def __init__(self, cursor, latency):
+        self.cursor = cursor
+        self.latency = latency
+        self.fast_executemany = False
+        self.round_trips = 0
+
+    def _round_trip(self, count=1):
+        self.round_trips += count
+        time.sleep(self.latency * count)
+
+    @staticmethod
+    def _translate(query):
+        # the few T-SQL statements used by SqlConnector, in SQLite
+        query = re.sub(r'SELECT TOP 0 (.*) INTO (\S+) FROM (\S+)', r'CREATE TEMP TABLE \2 AS SELECT \1 FROM \3 LIMIT 0',
+                       query)
+        query = re.sub(r'YEAR\(([^)]*)\)', r"CAST(strftime('%Y', \1) AS INTEGER)", query)
+        return query.replace('#', '')
+
+    def __getattr__(self, name):
+        # description, fetchall, rowcount...
+        return getattr(self.cursor, name)
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def execute(self, query, *params):
+        self._round_trip()
+        self.cursor.execute(self._translate(query), params)
+
+    def executemany(self, query, rows):
+        self._round_trip(1 if self.fast_executemany else len(rows))
+        self.cursor.executemany(self._translate(query), rows)
+
+
+if __name__ == '__main__':
+    # Inserts synthetic results into an SQLite stand-in for SQL Server that adds a network round trip latency: through
+    # a CSV file row by row as before, through a CSV file with array parameters (directly and through a staging
+    # table), and from the DataFrame without a CSV file
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--rows', type=int, default=20000, help='rows inserted')
+    ap.add_argument('-l', '--latency-ms', type=float, default=1.0, help='round trip time to the server')
+    ap.add_argument('-c', '--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help='rows sent at a time')
+    args = vars(ap.parse_args())
+    cols = ['episode_no', 'time_appeared', 'member']
+    results = pd.DataFrame({'episode_no': [i // 1000 + 1 for i in range(args['rows'])],
+                            'time_appeared': [datetime.time(0, i // 60 % 60, i % 60) for i in range(args['rows'])],
+                            'member': ['NO_BURN'] * args['rows']})
+
+    sqlite3.register_adapter(datetime.time, datetime.time.isoformat)
+
+    with TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'results.csv')
+
+        def row_by_row(connector):
+            # the previous implementation
+            results.to_csv(csv_path, index=False)
+            rows = pd.read_csv(csv_path, encoding='utf8', usecols=cols).values.tolist()
+            connector.cursor.executemany('INSERT INTO skull ("episode_no", "time_appeared", "member") '
+                                         'VALUES (?, ?, ?)', rows)
+            connector.conn.commit()
+
+        def through_csv(staged):
+            def insert(connector):
+                results.to_csv(csv_path, index=False)
+                connector.bulk_insert_csv(csv_path, 'skull', cols, args['chunk_rows'], staged)
+            return insert
+
+        def from_dataframe(connector):
+            connector.insert_records('skull', cols, results, ['int', 'time(3)', 'nvarchar(100)'], args['chunk_rows'])
+
+        for name, insert in (('csv, row by row', row_by_row), ('csv, fast_executemany', through_csv(False)),
+                             ('csv, staged', through_csv(True)), ('dataframe, fast_executemany', from_dataframe)):
+            connector = SqlConnector.__new__(SqlConnector)
+            connector.conn = sqlite3.connect(os.path.join(tmp, f'{name}.sqlite'))
+            connector.conn.execute('create table skull (id integer primary key, member text not null, '
+                                   'time_appeared text not null, episode_no int not null)')
+            connector.cursor = StandInCursor(connector.conn.cursor(), args['latency_ms'] / 1000)
+            start = time.perf_counter()
+            insert(connector)
+            elapsed = time.perf_counter() - start
+            inserted = connector.conn.execute('select count(*) from skull').fetchone()[0]
+            logger.info(f'{name}: {inserted} rows in {elapsed:.2f}s ({inserted / elapsed:.0f} rows/s, '
+                        f'{connector.cursor.round_trips} round trips)')
+            connector.conn.close()
@@ -1,4 +1,5 @@
 import re
+import datetime
 
 
 def get_episode_number_from_filename(episode_filename):
@@ -8,3 +9,9 @@ def get_episode_number_from_filename(episode_filename):
         raise Exception(f'Episode filename does not match pattern: {EPISODE_FILENAME_PATTERN}')
     episode_num = parsed[0]
     return episode_num
+
+
+def get_time_of_day_from_timestamp(timestamp):
+    """ datetime.time of a 'h:mm:ss:mmm' frame timestamp (the milliseconds are optional) """
+    h, m, s, *ms = timestamp.split(':')
+    return datetime.time(int(h), int(m), int(s), int(ms[0]) * 1000 if ms else 0)
@@ -0,0 +1,141 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from infinitechallenge.logging import logger
+from infinitechallenge.utils.ranged_download import ChecksumError
+
+# Description: Downloads upcoming files in the background while the current one is processed
+# Files are downloaded into a cache directory in the order they are requested, a few at a time. A prefetch only starts
+# while the cache (finished files, partial downloads, plus the size of the largest file seen so far for the download
+# being started) fits in the disk budget; files requested with get() are downloaded regardless of the budget.
+# Processed files are evicted with release(). A download that fails leaves its partial file (and the state files kept
+# next to it, e.g. by the ranged downloader) in the cache so that the next request resumes it, unless the partial data
+# is corrupt.
+
+
+class Prefetcher:
+    PARTIAL_SUFFIX = '.part'
+
+    def __init__(self, download, directory, budget_bytes, workers=1):
+        """
+        :param download: function(name, output_path) downloading the file called name to output_path, called from
+            background threads
+        :param directory: cache directory, created if missing
+        :param budget_bytes: disk space the cache may use for prefetched files
+        :param workers: number of files downloaded at the same time
+        """
+        self.download = download
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        # name -> future of started downloads, and names waiting for space in the budget
+        self.downloads = {}
+        self.waiting = OrderedDict()
+        self.largest_bytes = 0
+        self.active = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def used_bytes(self):
+        used = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                used += entry.stat().st_size
+        return used
+
+    def prefetch(self, name):
+        """ Starts downloading a file in the background, once it fits in the disk budget """
+        with self.lock:
+            if name in self.downloads or name in self.waiting:
+                return
+            self.waiting[name] = None
+            self._start_waiting()
+
+    def get(self, name):
+        """ Path to the downloaded file, blocks until its download is complete
+
+        :raises: the exception raised by the download, after which the file may be requested again
+        """
+        with self.lock:
+            if name not in self.downloads:
+                self.waiting.pop(name, None)
+                logger.info(f'{name} was not prefetched, downloading now')
+                self._start(name)
+            future = self.downloads[name]
+        try:
+            return future.result()
+        except Exception as ex:
+            with self.lock:
+                self.downloads.pop(name, None)
+            raise ex
+
+    def release(self, name):
+        """ Evicts a processed file from the cache, making room for the next prefetches """
+        with self.lock:
+            self.waiting.pop(name, None)
+            future = self.downloads.pop(name, None)
+        if future is not None:
+            # an interrupted download still has to finish (or fail) before its file can be removed
+            future.exception()
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+            self._remove_partial(self.path(name) + Prefetcher.PARTIAL_SUFFIX)
+            logger.debug(f'Evicted {name} from the prefetch cache')
+        with self.lock:
+            self._start_waiting()
+
+    def close(self):
+        with self.lock:
+            self.waiting.clear()
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _start_waiting(self):
+        # called with the lock held
+        while self.waiting and self.active < self.workers:
+            name = next(iter(self.waiting))
+            if self.used_bytes() + self.largest_bytes > self.budget_bytes:
+                logger.debug(f'Prefetch cache full, {len(self.waiting)} downloads waiting')
+                return
+            del self.waiting[name]
+            self._start(name)
+
+    def _start(self, name):
+        self.active += 1
+        self.downloads[name] = self.executor.submit(self._download, name)
+
+    def _download(self, name):
+        path = self.path(name)
+        partial_path = path + Prefetcher.PARTIAL_SUFFIX
+        logger.info(f'Prefetching {name}')
+        try:
+            self.download(name, partial_path)
+            os.replace(partial_path, path)
+        except ChecksumError as ex:
+            logger.error(f'Prefetching {name} failed, discarding the downloaded data: {ex}')
+            self._remove_partial(partial_path)
+            raise ex
+        except Exception as ex:
+            logger.error(f'Prefetching {name} failed, the next request resumes it: {ex}')
+            raise ex
+        finally:
+            with self.lock:
+                self.active -= 1
+                if os.path.exists(path):
+                    self.largest_bytes = max(self.largest_bytes, os.path.getsize(path))
+                self._start_waiting()
+        return path
+
+    def _remove_partial(self, partial_path):
+        """ Removes a partial download and the state files kept next to it (e.g. the ranged downloader's
+        <file>.ranges.json), so that the next download starts over """
+        prefix = os.path.basename(partial_path)
+        for entry in os.scandir(self.directory):
+            if entry.name == prefix or entry.name.startswith(prefix + '.'):
+                os.remove(entry.path)
@@ -0,0 +1,120 @@
+import io
+import struct
+import threading
+from infinitechallenge.logging import logger
+
+# Description: Reading a file while it is still being downloaded
+# The download runs in a background thread and reports how many bytes it has written; readers block on the bytes
+# that have not arrived yet. An MP4 can only be decoded from a stream if its index (moov atom) comes before the media
+# data (mdat atom), i.e. it was written with -movflags +faststart; faststart_header_size checks this from the first
+# bytes.
+
+
+class ProgressiveDownload:
+    def __init__(self, download, output_path):
+        """ Starts downloading in a background thread
+
+        :param download: function(output_path, on_progress) writing the file sequentially to output_path and calling
+            on_progress(bytes_written) as it goes
+        :param output_path: where the file is downloaded to
+        """
+        self.output_path = output_path
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, args=(download,), daemon=True)
+        self.thread.start()
+
+    def _run(self, download):
+        try:
+            download(self.output_path, self._on_progress)
+        except Exception as ex:
+            logger.error(f'Download to {self.output_path} failed: {ex}')
+            self.error = ex
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def _on_progress(self, size):
+        with self.condition:
+            self.size = size
+            self.condition.notify_all()
+
+    def wait_for(self, size):
+        """ Blocks until at least size bytes have been downloaded, or the download is complete
+
+        :return: number of bytes downloaded so far
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.size >= size or self.done)
+            if self.error is not None:
+                raise self.error
+            return self.size
+
+    def wait(self):
+        """ Blocks until the download is complete, returns the path of the downloaded file """
+        with self.condition:
+            self.condition.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return self.output_path
+
+    def open(self):
+        return GrowingFileReader(self)
+
+
+class GrowingFileReader(io.RawIOBase):
+    """ Sequential reader of a file being downloaded, reads block until the requested bytes have arrived """
+
+    def __init__(self, download):
+        self.download = download
+        self.file = None
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        available = self.download.wait_for(self.position + 1)
+        if available <= self.position:
+            # download complete
+            return 0
+        if self.file is None:
+            self.file = open(self.download.output_path, 'rb')
+        data = self.file.read(min(len(buffer), available - self.position))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        super().close()
+
+
+def faststart_header_size(download):
+    """ Walks the top level atoms of an MP4 being downloaded
+
+    :return: number of bytes up to the end of the moov atom if it comes before the mdat atom (the video can be decoded
+        while it downloads), None if the mdat atom comes first or the file does not look like an MP4
+    """
+    offset = 0
+    # the file exists once the first bytes have been written
+    if download.wait_for(8) < 8:
+        return None
+    with open(download.output_path, 'rb') as f:
+        while True:
+            if download.wait_for(offset + 16) < offset + 8:
+                return None
+            f.seek(offset)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            if size == 1:
+                # 64 bit size follows the type
+                size = struct.unpack('>Q', f.read(8))[0]
+            if kind == b'moov':
+                return offset + size
+            if kind == b'mdat' or size < 8 or not kind.isalnum():
+                return None
+            offset += size
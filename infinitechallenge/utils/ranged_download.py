@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from infinitechallenge.logging import logger
+
+# Description: Downloads a file over HTTP as concurrent byte ranges written into a preallocated file
+# Every range is fetched with its own Range request and written in place with os.pwrite. A range that fails part way
+# is retried from the last byte written, and the ranges that completed are recorded next to the file
+# (<file>.ranges.json) so that an interrupted download resumes where it stopped. The finished file can be verified
+# against an MD5 checksum (e.g. Drive's md5Checksum).
+
+MB = 1024 * 1024
+
+
+class ChecksumError(Exception):
+    def __init__(self, path, expected, actual):
+        super().__init__(f'MD5 of {path} is {actual}, expected {expected}')
+
+
+def file_md5(path, block_size=8 * MB):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class RangedDownloader:
+    def __init__(self, session_factory, chunk_size=32 * MB, parallelism=8, max_retries=5, backoff=1.0,
+                 block_size=MB):
+        """
+        :param session_factory: function returning a requests.Session-like object (e.g. an AuthorizedSession), one
+            is created for each download thread
+        :param chunk_size: bytes per range request
+        :param parallelism: number of ranges downloaded at the same time
+        :param max_retries: retries of a range before the download fails
+        :param backoff: seconds to wait before the first retry of a range, doubled on every retry
+        :param block_size: bytes read from the response and written to the file at a time
+        """
+        self.session_factory = session_factory
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.block_size = block_size
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.session_factory()
+        return self.local.session
+
+    def download(self, url, output_path, size, md5=None):
+        """ Downloads size bytes from url into output_path
+
+        :param md5: expected hex MD5 of the file, not verified if None
+        :raises ChecksumError: if the downloaded file does not match md5, the download then starts over on the next call
+        """
+        state_path = output_path + '.ranges.json'
+        ranges = [(start, min(start + self.chunk_size, size)) for start in range(0, size, self.chunk_size)]
+        done = self._load_state(state_path, output_path, size)
+        pending = [r for r in ranges if r[0] not in done]
+        if len(pending) < len(ranges):
+            logger.info(f'Resuming download of {output_path}: {len(ranges) - len(pending)}/{len(ranges)} ranges done')
+
+        start_time = time.perf_counter()
+        fd = os.open(output_path, os.O_RDWR | os.O_CREAT)
+        lock = threading.Lock()
+        try:
+            os.ftruncate(fd, size)
+
+            def fetch(byte_range):
+                self._fetch_range(url, fd, *byte_range)
+                with lock:
+                    done.add(byte_range[0])
+                    self._save_state(state_path, size, done)
+                    logger.debug(f'{output_path}: {len(done)}/{len(ranges)} ranges done')
+
+            with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+                # list() re-raises the first range that ran out of retries
+                list(executor.map(fetch, pending))
+        finally:
+            os.close(fd)
+
+        elapsed = time.perf_counter() - start_time
+        fetched = sum(end - start for start, end in pending)
+        logger.info(f'Downloaded {fetched / MB:.1f}MB in {elapsed:.1f}s ({fetched / MB / max(elapsed, 1e-9):.1f}MB/s, '
+                    f'{self.parallelism} ranges at a time)')
+        # the next download starts over, whether this one is verified or not
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        if md5 is not None:
+            actual = file_md5(output_path)
+            if actual != md5:
+                raise ChecksumError(output_path, md5, actual)
+        return output_path
+
+    def _fetch_range(self, url, fd, start, end):
+        """ Writes bytes [start, end) of url at the same offsets of fd, resuming from the last byte written on retry """
+        offset = start
+        attempt = 0
+        while offset < end:
+            try:
+                response = self.session().get(url, headers={'Range': f'bytes={offset}-{end - 1}'}, stream=True,
+                                              timeout=60)
+                try:
+                    if response.status_code != 206:
+                        raise IOError(f'Range request for bytes {offset}-{end - 1} returned {response.status_code}')
+                    for block in response.iter_content(self.block_size):
+                        block = block[:end - offset]
+                        os.pwrite(fd, block, offset)
+                        offset += len(block)
+                finally:
+                    response.close()
+                if offset < end:
+                    raise IOError(f'Range {offset}-{end - 1} ended early')
+            except IOError as ex:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f'Range {start}-{end - 1} failed after {self.max_retries} retries: {ex}')
+                    raise ex
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.warning(f'Range {start}-{end - 1} failed at byte {offset} ({ex}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def _load_state(self, state_path, output_path, size):
+        try:
+            with open(state_path, encoding='utf8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return set()
+        if state.get('size') != size or state.get('chunk_size') != self.chunk_size or not os.path.exists(output_path):
+            return set()
+        return set(state['done'])
+
+    def _save_state(self, state_path, size, done):
+        temp_path = state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump({'size': size, 'chunk_size': self.chunk_size, 'done': sorted(done)}, f)
+        os.replace(temp_path, state_path)
+
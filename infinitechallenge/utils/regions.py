@@ -0,0 +1,74 @@
+# Description: Helpers for (top, right, bottom, left) bounding boxes, as used for skull and face coordinates
+
+
+def scale_box(box, factor):
+    top, right, bottom, left = box
+    return int(top * factor), int(right * factor), int(bottom * factor), int(left * factor)
+
+
+def expand_box(box, factor, shape):
+    """ Grows a box around its centre by factor, clipped to an image of the given shape
+
+    :param box: (top, right, bottom, left)
+    :param factor: ratio of the expanded box's sides to the original box's sides
+    :param shape: shape of the image, (height, width, ...)
+    :return: expanded (top, right, bottom, left)
+    """
+    top, right, bottom, left = box
+    height, width = shape[:2]
+    half_h = (bottom - top) * factor / 2.0
+    half_w = (right - left) * factor / 2.0
+    centre_y = (top + bottom) / 2.0
+    centre_x = (left + right) / 2.0
+    return (max(0, int(centre_y - half_h)), min(width, int(centre_x + half_w)),
+            min(height, int(centre_y + half_h)), max(0, int(centre_x - half_w)))
+
+
+def union_box(boxes):
+    """ Smallest box containing all of the given boxes """
+    return (min(top for top, right, bottom, left in boxes), max(right for top, right, bottom, left in boxes),
+            max(bottom for top, right, bottom, left in boxes), min(left for top, right, bottom, left in boxes))
+
+
+def crop(image, box):
+    top, right, bottom, left = box
+    return image[top:bottom, left:right]
+
+
+def offset_boxes(boxes, origin):
+    """ Maps boxes found in a crop back to the coordinates of the image it was cropped from
+
+    :param boxes: boxes relative to the crop
+    :param origin: (top, right, bottom, left) of the crop in the image
+    :return: boxes relative to the image
+    """
+    top, right, bottom, left = origin
+    return [(t + top, r + left, b + top, l + left) for (t, r, b, l) in boxes]
+
+
+def relative_boxes(boxes, origin):
+    """ Maps boxes in an image to the coordinates of a crop of that image, the inverse of offset_boxes """
+    top, right, bottom, left = origin
+    return [(t - top, r - left, b - top, l - left) for (t, r, b, l) in boxes]
+
+
+def roi_around(boxes, factor, shape):
+    """ Region of interest around boxes: the smallest box containing all of the boxes expanded by factor """
+    return union_box([expand_box(box, factor, shape) for box in boxes])
+
+
+def intersection_over_union(box1, box2):
+    t1, r1, b1, l1 = box1
+    t2, r2, b2, l2 = box2
+    intersection = max(0, min(b1, b2) - max(t1, t2)) * max(0, min(r1, r2) - max(l1, l2))
+    union = (b1 - t1) * (r1 - l1) + (b2 - t2) * (r2 - l2) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def merge_boxes(boxes, extra_boxes, threshold=0.5):
+    """ Adds the extra boxes that do not overlap (IoU above threshold) any of the boxes """
+    merged = list(boxes)
+    for extra in extra_boxes:
+        if all(intersection_over_union(extra, box) <= threshold for box in merged):
+            merged.append(extra)
+    return merged
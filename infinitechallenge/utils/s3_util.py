@@ -1,13 +1,17 @@
 import boto3
 import os
-from tempfile import TemporaryDirectory
+from tempfile import mkdtemp
+from boto3.s3.transfer import TransferConfig
 from infinitechallenge.logging import logger
 
+MB = 1024 * 1024
+
 
 # Assign an IAM Role with permission to GetObject from S3, boto3 will get
 # credentials from instance metadata
 # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
 def s3_download(region_name, bucket_name, filename):
+    """ Object contents in memory, only for small objects: use s3_download_to_file for episodes """
     #adapted from
     #https://www.thetechnologyupdates.com/image-processing-opencv-with-aws-lambda/
     s3 = boto3.client('s3', region_name=region_name)
@@ -22,11 +26,41 @@ def s3_download(region_name, bucket_name, filename):
         raise ex
 
 
-def cache_episode_from_s3(region, bucket_name, episode_name):
-    video = s3_download(region, bucket_name, episode_name)
-    dir = TemporaryDirectory()
-    path = os.path.join(dir.name, episode_name)
-    file = open(path, 'rb')
-    file.write(video)
-    logger.info(f'Episode will be cached @ {file.name}')
-    return file
+def s3_download_to_file(s3, bucket_name, key, output_path, chunksize=8 * MB, concurrency=8, on_progress=None):
+    """ Downloads an object to disk, holding at most a few chunks in memory whatever the size of the object
+
+    :param s3: boto3 S3 client
+    :param chunksize: bytes per ranged GET (and per read when streaming)
+    :param concurrency: ranged GETs at the same time
+    :param on_progress: if given, the object is instead streamed sequentially and on_progress is called with the
+        number of bytes written so far, so that the file can be read while it downloads
+    """
+    logger.info(f'Downloading: [{bucket_name}/{key}]')
+    try:
+        if on_progress is None:
+            # managed transfer: multipart ranged GETs written straight to the file
+            config = TransferConfig(multipart_threshold=chunksize, multipart_chunksize=chunksize,
+                                    max_concurrency=concurrency, use_threads=concurrency > 1)
+            s3.download_file(bucket_name, key, output_path, Config=config)
+        else:
+            body = s3.get_object(Bucket=bucket_name, Key=key)['Body']
+            written = 0
+            with open(output_path, 'wb', buffering=0) as f:
+                for chunk in body.iter_chunks(chunksize):
+                    f.write(chunk)
+                    written += len(chunk)
+                    on_progress(written)
+        logger.info(f'Complete: [{bucket_name}/{key}]')
+        return output_path
+    except BaseException as ex:
+        logger.error(f'Download failed')
+        raise ex
+
+
+def cache_episode_from_s3(region, bucket_name, episode_name, directory=None):
+    """ Downloads an episode to directory (a new temporary directory if not given) and returns its path """
+    s3 = boto3.client('s3', region_name=region)
+    path = os.path.join(directory or mkdtemp(), episode_name)
+    logger.info(f'Episode will be cached @ {path}')
+    return s3_download_to_file(s3, bucket_name, episode_name, path)
+
@@ -1,68 +1,432 @@
+import os
+import re
+import threading
+import time
 import pyodbc
 import pandas as pd
+from contextlib import contextmanager, ExitStack
 from infinitechallenge.logging import logger
 
 # Description: Connects to SQL Server and execute bulk insert & other queries
 # Developed Date: 3 Jul 2020
 # Developer: Ko Gi Hun
 
+DEFAULT_CHUNK_ROWS = 10000
+DEFAULT_FETCH_ROWS = 10000
+DEFAULT_POOL_SIZE = 2
+DEFAULT_CHECK_AFTER = 30
+# member of the rows of skulls that burned nobody, see Phase3
+NO_BURN = 'NO_BURN'
+# columns burn_counts can group by, s is the skull table and e the episode table
+BURN_GROUPS = {'member': 's.member',
+               'episode': 's.episode_no',
+               'year': 'YEAR(e.airDate)'}
+# T-SQL types values can be sent as, see SqlConnector.insert_records
+SQL_TYPES = {'int': pyodbc.SQL_INTEGER,
+             'bigint': pyodbc.SQL_BIGINT,
+             'float': pyodbc.SQL_DOUBLE,
+             'bit': pyodbc.SQL_BIT,
+             'date': pyodbc.SQL_TYPE_DATE,
+             'time': pyodbc.SQL_SS_TIME2,
+             'datetime2': pyodbc.SQL_TYPE_TIMESTAMP,
+             'varchar': pyodbc.SQL_VARCHAR,
+             'nvarchar': pyodbc.SQL_WVARCHAR}
 
-class SqlConnector:
-    def __init__(self, db_endpoint, db_name, db_uid, db_pw):
-        connection_string = 'DRIVER={ODBC Driver 17 for SQL Server}; ' \
-                                 + f'SERVER={db_endpoint}; ' \
-                                   f'DATABASE={db_name}; ' \
-                                   f'UID={db_uid}; ' \
-                                   f'PWD={db_pw}'
 
+def build_connection_string(db_endpoint, db_name, db_uid, db_pw):
+    return 'DRIVER={ODBC Driver 17 for SQL Server}; ' \
+           + f'SERVER={db_endpoint}; ' \
+             f'DATABASE={db_name}; ' \
+             f'UID={db_uid}; ' \
+             f'PWD={db_pw}'
+
+
+class ConnectionPool:
+    def __init__(self, connect, name, size=DEFAULT_POOL_SIZE, check_after=DEFAULT_CHECK_AFTER):
+        """ Open connections to one database, reused instead of connecting for every SqlConnector
+
+        :param connect: function opening a new connection
+        :param name: database name for the logs (the connection string holds the password)
+        :param size: maximum number of open connections, connection() blocks while they are all in use
+        :param check_after: seconds a connection may stay idle before it is checked with a query on reuse, a connection
+            that was dropped in the meantime (e.g. by the server or a NAT timeout) is replaced with a new one
+        """
+        self.connect = connect
+        self.name = name
+        self.size = size
+        self.check_after = check_after
+        # (connection, time it was returned), the most recently used last
+        self.idle = []
+        self.opened = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """ Borrows a connection, returned to the pool at the end of the with block unless it failed """
+        conn = self._acquire()
+        reusable = True
+        try:
+            yield conn
+        except BaseException as ex:
+            # whatever failed, the next borrower must not inherit (and commit) an open transaction
+            reusable = not (isinstance(ex, pyodbc.Error) and _is_disconnect(ex))
+            if reusable:
+                try:
+                    conn.rollback()
+                except pyodbc.Error:
+                    reusable = False
+            raise ex
+        finally:
+            self._release(conn, reusable)
+
+    def close(self):
+        """ Closes the idle connections, connections in use are closed when they are returned """
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+            self.closed = True
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def _acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.idle or self.opened < self.size)
+            if self.idle:
+                conn, returned_at = self.idle.pop()
+            else:
+                conn, returned_at = None, None
+                self.opened += 1
+        if conn is not None:
+            if time.monotonic() - returned_at < self.check_after or _is_alive(conn):
+                return conn
+            logger.warning(f'Connection to {self.name} was dropped, reconnecting')
+            _close_quietly(conn)
         try:
-            logger.debug(connection_string)
-            self.conn = pyodbc.connect(connection_string)
-            self.cursor = self.conn.cursor()
-            logger.info('Able to connect.')
+            start = time.perf_counter()
+            conn = self.connect()
+            logger.info(f'Connected to {self.name} in {time.perf_counter() - start:.2f}s')
+            return conn
         except pyodbc.Error as ex:
-            logger.error('Failed to connect.')
+            logger.error(f'Failed to connect to {self.name}.')
+            self._release(None, False)
             raise ex
 
-    def execute(self, query, type):
-        logger.info(query)
+    def _release(self, conn, reusable):
+        with self.condition:
+            if reusable and not self.closed:
+                self.idle.append((conn, time.monotonic()))
+                conn = None
+            else:
+                self.opened -= 1
+            self.condition.notify()
+        if conn is not None:
+            _close_quietly(conn)
+
+
+def _is_alive(conn):
+    try:
+        conn.execute('SELECT 1').fetchone()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+def _is_disconnect(ex):
+    # SQLSTATE class 08: connection exceptions
+    return bool(ex.args) and str(ex.args[0]).startswith('08')
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+
+
+# pools of this process by connection string, connections are not shared with forked processes
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_endpoint, db_name, db_uid, db_pw, size=DEFAULT_POOL_SIZE):
+    """ Pool shared by every SqlConnector to the same database in this process """
+    connection_string = build_connection_string(db_endpoint, db_name, db_uid, db_pw)
+    key = (os.getpid(), connection_string)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(lambda: pyodbc.connect(connection_string), f'{db_endpoint}/{db_name}', size)
+        return _pools[key]
+
+
+def close_pools():
+    """ Closes the idle connections of every pool of this process, e.g. when a worker stops """
+    with _pools_lock:
+        pools = [pool for (pid, _), pool in _pools.items() if pid == os.getpid()]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+class SqlConnector:
+    def __init__(self, db_endpoint, db_name, db_uid, db_pw, pool_size=DEFAULT_POOL_SIZE):
+        """ Borrows a pooled connection for every call, or for a whole with block:
+
+            with SqlConnector(...) as database:
+                database.insert_records(...)
+                database.execute(...)
+        """
+        self.pool = get_pool(db_endpoint, db_name, db_uid, db_pw, pool_size)
+        self.conn = None
+        self.cursor = None
+        self._borrowed = None
+
+    def __enter__(self):
+        self._borrowed = self.pool.connection()
+        self.conn = self._borrowed.__enter__()
+        self.cursor = self.conn.cursor()
+        return self
+
+    def __exit__(self, *exc_info):
+        borrowed, self._borrowed = self._borrowed, None
+        self.conn = self.cursor = None
+        return borrowed.__exit__(*exc_info)
+
+    @contextmanager
+    def _connection(self):
+        if self.conn is not None:
+            # within a with block
+            yield
+            return
+        with self.pool.connection() as conn:
+            self.conn, self.cursor = conn, conn.cursor()
+            try:
+                yield
+            finally:
+                self.conn = self.cursor = None
+
+    def execute(self, query, type, *params):
+        """ Runs a query with ? placeholders bound to params
+
+        The query text stays the same whatever the values, so the server reuses its cached plan. Outside a with block
+        every call runs on a new cursor, so only within one does pyodbc also reuse the prepared statement.
+
+        :param type: 'SELECT' returns every row as a dict (see iter_rows and read_dataframes for large results), other
+            statements are committed and return the number of rows affected
+        """
+        logger.debug(query)
+        start = time.perf_counter()
         try:
-            self.cursor.execute(query)
-            # SELECT OPERATION
-            if type == 'SELECT':
-                columns = [column[0] for column in self.cursor.description]
-                results = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-                logger.info(results)
-                return results
-            # SINGLE INSERT OPERATION
-            elif type == 'INSERT':
+            with self._connection():
+                self.cursor.execute(query, *params)
+                # SELECT OPERATION
+                if type == 'SELECT':
+                    columns = [column[0] for column in self.cursor.description]
+                    results = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+                    logger.debug(f'{len(results)} rows in {time.perf_counter() - start:.3f}s')
+                    return results
+                # INSERT, UPDATE, DELETE... OPERATION
+                rowcount = self.cursor.rowcount
                 self.conn.commit()
+                return rowcount
+        except pyodbc.Error as ex:
+            logger.error(ex)
+            raise ex
+
+    def iter_rows(self, query, *params, batch_rows=DEFAULT_FETCH_ROWS):
+        """ Rows of a SELECT as dicts, fetched batch_rows at a time as they are iterated """
+        for columns, rows in self._fetch_batches(query, params, batch_rows):
+            for row in rows:
+                yield dict(zip(columns, row))
+
+    def read_dataframes(self, query, *params, chunk_rows=DEFAULT_FETCH_ROWS):
+        """ Rows of a SELECT as DataFrames of up to chunk_rows rows, fetched as they are iterated """
+        for columns, rows in self._fetch_batches(query, params, chunk_rows):
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+    def _fetch_batches(self, query, params, batch_rows):
+        """ (column names, rows) batches from a cursor of its own, on a pooled connection of its own outside a with
+        block. Within a with block, the iteration has to finish before the next query on the connection. """
+        logger.debug(query)
+        start = time.perf_counter()
+        count = 0
+        try:
+            with ExitStack() as stack:
+                conn = self.conn if self.conn is not None else stack.enter_context(self.pool.connection())
+                cursor = conn.cursor()
+                # also discards the rows left when the iteration stops early
+                stack.callback(cursor.close)
+                cursor.execute(query, *params)
+                columns = [column[0] for column in cursor.description]
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    count += len(rows)
+                    yield columns, rows
         except pyodbc.Error as ex:
             logger.error(ex)
             raise ex
+        logger.debug(f'{count} rows in {time.perf_counter() - start:.3f}s')
+
+    def member_burns(self, member, table_name='skull'):
+        """ Every burn of member, in order: episode_no, airDate and time_appeared """
+        return self.execute(f'SELECT s.episode_no, e.airDate, s.time_appeared FROM {table_name} AS s '
+                            f'JOIN episode AS e ON e.epNo = s.episode_no '
+                            f'WHERE s.member = ? ORDER BY s.episode_no, s.time_appeared', 'SELECT', member)
+
+    def burn_counts(self, by=('member',), member=None, table_name='skull'):
+        """ Number of burns (column burns) grouped by any of BURN_GROUPS, in the order of the groups
+
+        :param by: e.g. ['year'] for burns per year, ['member', 'year'] for burns of every member per year
+        :param member: only count the burns of member
+        """
+        unknown = set(by) - set(BURN_GROUPS)
+        if unknown or not by:
+            raise ValueError(f'Cannot group burns by {by}, groups are {list(BURN_GROUPS)}')
+        groups = ', '.join(BURN_GROUPS[group] for group in by)
+        columns = ', '.join(f'{BURN_GROUPS[group]} AS {group}' for group in by)
+        # the episode table is only needed for air dates
+        join = 'JOIN episode AS e ON e.epNo = s.episode_no ' if 'year' in by else ''
+        conditions = 's.member <> ?' + (' AND s.member = ?' if member is not None else '')
+        params = [NO_BURN] + ([member] if member is not None else [])
+        return self.execute(f'SELECT {columns}, COUNT(*) AS burns FROM {table_name} AS s {join}'
+                            f'WHERE {conditions} GROUP BY {groups} ORDER BY {groups}', 'SELECT', *params)
+
+    def bulk_insert_csv(self, file_path, table_name, cols, chunk_rows=DEFAULT_CHUNK_ROWS, staged=False):
+        """ Inserts the cols columns of a CSV file into table_name, in a single transaction
 
-    def bulk_insert_csv(self, file_path, table_name, cols):
+        :param chunk_rows: rows read from the file and sent to the server at a time
+        :param staged: load the rows into a temporary staging table first and copy them into table_name with a single
+            INSERT ... SELECT, for large backfills
+        """
         try:
             # Reading from CSV file
-            df = pd.read_csv(file_path, encoding='utf8', usecols=cols)
-            df = df.values.tolist()
-            if not df:
-                logger.info('No entries to insert into database.')
-                return
-            logger.info('Successfully read {} rows from CSV file {}'.format(len(df), file_path))
+            chunks = pd.read_csv(file_path, encoding='utf8', usecols=cols, chunksize=chunk_rows)
+            rows = (row for chunk in chunks for row in chunk.values.tolist())
         except pd.io.common.EmptyDataError as ex:
             logger.error(ex)
             raise ex
+        with self._connection():
+            count = self._insert_rows(table_name, cols, rows, chunk_rows, staged)
+        if count:
+            logger.info(f'Inserted {count} rows from CSV file {file_path}')
+
+    def insert_records(self, table_name, cols, records, types=None, chunk_rows=DEFAULT_CHUNK_ROWS, staged=False,
+                       key_cols=None, replace_where=None):
+        """ Inserts records into table_name, in a single transaction
+
+        :param records: iterable of sequences of values in the order of cols, or a DataFrame with the cols columns,
+            sent chunk_rows at a time
+        :param types: T-SQL types of cols the values are sent as (e.g. ['int', 'time(3)', 'nvarchar(100)']), inferred
+            from the values if None
+        :param staged: see bulk_insert_csv
+        :param key_cols: if given, a record whose key_cols values match a row of table_name updates that row instead of
+            being inserted (the records are then always staged)
+        :param replace_where: if given, {column: value} of the rows of table_name deleted before inserting, e.g. the
+            previous results of the episode being inserted
+        :return: number of rows inserted or updated
+        """
+        if isinstance(records, pd.DataFrame):
+            records = _dataframe_rows(records[cols], chunk_rows)
+        with self._connection():
+            return self._insert_rows(table_name, cols, records, chunk_rows, staged, types, key_cols, replace_where)
+
+    def _insert_rows(self, table_name, cols, rows, chunk_rows, staged, types=None, key_cols=None, replace_where=None):
+        """ Inserts an iterable of rows (sequences of values in the order of cols), returns the number of rows """
+        staged = staged or key_cols is not None
+        column_str = ', '.join(f'"{col}"' for col in cols)
+        wildcard_str = ', '.join('?' for _ in cols)
+        target = f'#{table_name}_staging' if staged else table_name
+        query_template = f'INSERT INTO {target} ({column_str}) VALUES ({wildcard_str})'
+        logger.debug(f'executemany query template: \'{query_template}\'')
+        # unsupported types fail before anything is deleted
+        input_sizes = [_input_size(sql_type) for sql_type in types] if types is not None else None
+        start = time.perf_counter()
+        count = 0
         try:
-            column_str = str(tuple(cols)).replace("'", "\"")
-            wildcard_str = str(tuple(map(lambda x: "?", cols))).replace("'", "")
-            query_template = 'INSERT INTO {} {} VALUES {}'.format(table_name, column_str, wildcard_str)
-            logger.debug(f'executemany query template: \'{query_template}\'')
-            # Performing Bulk Insert into RDS
-            logger.debug(df)
-            self.cursor.executemany(query_template, df)
-            self.cursor.commit()
-            logger.info('Insert success.')
-        except pyodbc.Error as ex:
+            if replace_where:
+                conditions = ' AND '.join(f'"{col}" = ?' for col in replace_where)
+                self.cursor.execute(f'DELETE FROM {table_name} WHERE {conditions}', *replace_where.values())
+                logger.info(f'Deleted {self.cursor.rowcount} rows of {table_name} to be replaced')
+            # parameters are sent as arrays, one round trip per chunk instead of one per row
+            self.cursor.fast_executemany = True
+            if staged:
+                self.cursor.execute(f'SELECT TOP 0 {column_str} INTO {target} FROM {table_name}')
+            if input_sizes is not None:
+                self.cursor.setinputsizes(input_sizes)
+            for chunk in _chunks(rows, chunk_rows):
+                self.cursor.executemany(query_template, chunk)
+                count += len(chunk)
+                logger.debug(f'Sent {count} rows')
+            if not count and not replace_where:
+                logger.info('No entries to insert into database.')
+                self.conn.rollback()
+                return 0
+            if staged:
+                for query in _copy_staged_queries(table_name, target, cols, key_cols):
+                    self.cursor.execute(query)
+                self.cursor.execute(f'DROP TABLE {target}')
+            self.conn.commit()
+        except BaseException as ex:
+            # e.g. a record that cannot be converted after the DELETE: nothing of the transaction may stay open, the
+            # rollback also drops the staging table, which was created in the transaction
             logger.error(ex)
+            if not (isinstance(ex, pyodbc.Error) and _is_disconnect(ex)):
+                self.conn.rollback()
             raise ex
+        finally:
+            if input_sizes is not None:
+                self.cursor.setinputsizes(None)
+        elapsed = time.perf_counter() - start
+        logger.info(f'Insert success: {count} rows in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s)')
+        return count
+
+
+def _copy_staged_queries(table_name, staging_table, cols, key_cols=None):
+    """ Statements copying the rows of staging_table into table_name, updating the rows with the same key_cols """
+    column_str = ', '.join(f'"{col}"' for col in cols)
+    if key_cols is None:
+        return [f'INSERT INTO {table_name} ({column_str}) SELECT {column_str} FROM {staging_table}']
+    # an UPDATE ... FROM and an INSERT ... WHERE NOT EXISTS in the same transaction rather than a MERGE
+    matches = ' AND '.join(f'{table_name}."{col}" = s."{col}"' for col in key_cols)
+    value_cols = [col for col in cols if col not in key_cols]
+    queries = []
+    if value_cols:
+        assignments = ', '.join(f'"{col}" = s."{col}"' for col in value_cols)
+        queries.append(f'UPDATE {table_name} SET {assignments} FROM {staging_table} AS s WHERE {matches}')
+    queries.append(f'INSERT INTO {table_name} ({column_str}) SELECT {column_str} FROM {staging_table} AS s '
+                   f'WHERE NOT EXISTS (SELECT 1 FROM {table_name} WHERE {matches})')
+    return queries
+
+
+def _input_size(sql_type):
+    """ pyodbc input size (type, column size, decimal digits) of a T-SQL type such as 'nvarchar(100)' or 'time(3)' """
+    match = re.fullmatch(r'(\w+)(?:\((\w+)\))?', sql_type.strip().lower())
+    if match is None or match.group(1) not in SQL_TYPES:
+        raise ValueError(f'Unsupported SQL type: {sql_type}')
+    name, size = match.groups()
+    if name == 'time':
+        # size is the number of fractional digits, time(7) by default
+        digits = int(size) if size is not None else 7
+        return SQL_TYPES[name], 8 + digits + (digits > 0), digits
+    # 0 for (max) and types without a size
+    return SQL_TYPES[name], int(size) if size is not None and size.isdigit() else 0, 0
+
+
+def _dataframe_rows(df, chunk_rows):
+    """ Rows of df as tuples of python values (None for missing values), converted chunk_rows at a time """
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].astype(object)
+        yield from chunk.where(chunk.notna(), None).itertuples(index=False, name=None)
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,182 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from infinitechallenge.logging import logger
+
+# Description: Where episodes are read from and artefacts are uploaded to
+# Remote paths are '<folder>/<file>' (e.g. episodes/episode1.mp4, episode1_output/phase1_results.csv) whatever the
+# backend. The backend is selected by the storage_backend option of a phase's config section:
+#   gdrive  Google Drive, authenticated with the IC_GDRIVE_* environment variables (default)
+#   s3      bucket s3_bucket in region s3_region, under the optional key prefix s3_prefix
+#   local   directory storage_directory, for runs and benchmarks without any network
+# Each backend only imports its client library when it is created.
+
+MB = 1024 * 1024
+
+
+class Storage:
+    def download(self, remote_path, local_path, chunksize=8 * MB, parallelism=1, on_progress=None):
+        """ Downloads remote_path to local_path
+
+        :param chunksize: bytes requested at a time
+        :param parallelism: chunks downloaded at the same time, where the backend supports it
+        :param on_progress: called with the number of bytes written to local_path so far, the file is then written
+            sequentially so that it can be read while it downloads
+        """
+        raise NotImplementedError
+
+    def upload(self, local_path, remote_path):
+        raise NotImplementedError
+
+    def upload_many(self, local_paths, remote_dir, workers=8):
+        """ Uploads local files into remote_dir, keeping their file names """
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda path: self.upload(path, os.path.join(remote_dir, os.path.basename(path))),
+                              local_paths))
+        logger.info(f'Uploaded {len(local_paths)} files to {remote_dir} in {time.perf_counter() - start:.1f}s')
+
+    def list(self, remote_dir):
+        """ Names of the files in remote_dir, empty if it does not exist """
+        raise NotImplementedError
+
+    def exists(self, remote_path):
+        raise NotImplementedError
+
+
+class GDriveStorage(Storage):
+    def __init__(self, config):
+        from infinitechallenge.utils.gdrivefile_util import create_gdrive
+        self.gdrive = create_gdrive(config)
+
+    def download(self, remote_path, local_path, chunksize=8 * MB, parallelism=1, on_progress=None):
+        self.gdrive.download_file(remote_path, local_path, chunksize, on_progress, parallelism)
+
+    def upload(self, local_path, remote_path):
+        self.gdrive.upload_file(local_path, remote_filepath=remote_path)
+
+    def upload_many(self, local_paths, remote_dir, workers=8):
+        self.gdrive.upload_many(local_paths, remote_dir, workers)
+
+    def list(self, remote_dir):
+        return self.gdrive.list_folder(remote_dir)
+
+    def exists(self, remote_path):
+        return self.gdrive.exists(remote_path)
+
+
+class S3Storage(Storage):
+    def __init__(self, region_name, bucket_name, prefix=''):
+        import boto3
+        self.s3 = boto3.client('s3', region_name=region_name)
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def key(self, remote_path):
+        return self.prefix + remote_path.replace(os.path.sep, '/')
+
+    def download(self, remote_path, local_path, chunksize=8 * MB, parallelism=1, on_progress=None):
+        from infinitechallenge.utils.s3_util import s3_download_to_file
+        s3_download_to_file(self.s3, self.bucket_name, self.key(remote_path), local_path, chunksize, parallelism,
+                            on_progress)
+
+    def upload(self, local_path, remote_path):
+        logger.info(f'Uploading {os.path.basename(local_path)}')
+        self.s3.upload_file(local_path, self.bucket_name, self.key(remote_path))
+
+    def list(self, remote_dir):
+        prefix = self.key(remote_dir).rstrip('/') + '/'
+        names = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                                                      Delimiter='/'):
+            names += [item['Key'][len(prefix):] for item in page.get('Contents', [])]
+        return names
+
+    def exists(self, remote_path):
+        from botocore.exceptions import ClientError
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=self.key(remote_path))
+            return True
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise ex
+
+
+class LocalStorage(Storage):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, remote_path):
+        return os.path.join(self.root, remote_path)
+
+    def download(self, remote_path, local_path, chunksize=8 * MB, parallelism=1, on_progress=None):
+        source = self.path(remote_path)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f'{remote_path} does not exist in {self.root}')
+        if on_progress is None:
+            shutil.copyfile(source, local_path)
+            return
+        written = 0
+        with open(source, 'rb') as src, open(local_path, 'wb', buffering=0) as dst:
+            for chunk in iter(lambda: src.read(chunksize), b''):
+                dst.write(chunk)
+                written += len(chunk)
+                on_progress(written)
+
+    def upload(self, local_path, remote_path):
+        destination = self.path(remote_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(local_path, destination)
+
+    def list(self, remote_dir):
+        directory = self.path(remote_dir)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+
+    def exists(self, remote_path):
+        return os.path.isfile(self.path(remote_path))
+
+
+class LazyStorage(Storage):
+    """ Storage selected by a config section, created on first use so that runs that neither download nor upload need
+    no credentials """
+
+    def __init__(self, config):
+        self.config = config
+        self._storage = None
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = create_storage(self.config)
+        return self._storage
+
+    def download(self, remote_path, local_path, chunksize=8 * MB, parallelism=1, on_progress=None):
+        self.storage.download(remote_path, local_path, chunksize, parallelism, on_progress)
+
+    def upload(self, local_path, remote_path):
+        self.storage.upload(local_path, remote_path)
+
+    def upload_many(self, local_paths, remote_dir, workers=8):
+        self.storage.upload_many(local_paths, remote_dir, workers)
+
+    def list(self, remote_dir):
+        return self.storage.list(remote_dir)
+
+    def exists(self, remote_path):
+        return self.storage.exists(remote_path)
+
+
+def create_storage(config):
+    """ Storage backend selected by the storage_backend option of a config section """
+    backend = config.get('storage_backend', 'gdrive')
+    if backend == 'gdrive':
+        return GDriveStorage(config)
+    elif backend == 's3':
+        return S3Storage(config['s3_region'], config['s3_bucket'], config.get('s3_prefix', ''))
+    elif backend == 'local':
+        return LocalStorage(config['storage_directory'])
+    raise ValueError(f'Unknown storage backend: {backend}')
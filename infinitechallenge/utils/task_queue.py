@@ -0,0 +1,260 @@
+import os
+import socket
+import sqlite3
+import time
+from infinitechallenge.logging import logger
+
+# Description: Durable queue of episode x phase tasks, shared by any number of workers
+# A task becomes claimable once the task for the previous phase of the same episode is done, failed tasks are retried
+# until they run out of attempts, and completed tasks are never run again.
+# Claiming a task takes a lease on it. The worker renews the lease with heartbeats while it runs the task; when a
+# worker dies (or stalls) its lease expires and the task is handed to another worker. Lease times use each worker's
+# clock, so lease durations should be far longer than the clock skew between nodes.
+#   TaskQueue          local SQLite database, for a single machine (or several worker processes on it)
+#   SqlServerTaskQueue dbo.task table in the project's SQL Server database, for workers on several nodes
+
+
+def default_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Task:
+    def __init__(self, episode_no, phase, attempts, owner):
+        self.episode_no = episode_no
+        self.phase = phase
+        self.attempts = attempts
+        self.owner = owner
+
+    def __str__(self):
+        return f'episode{self.episode_no}:{self.phase}'
+
+
+class TaskQueue:
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    DEFAULT_LEASE_SECONDS = 300
+
+    COLUMNS = {'episode_no': 'INTEGER NOT NULL',
+               'phase': 'VARCHAR(20) NOT NULL',
+               'phase_order': 'INTEGER NOT NULL',
+               'status': 'VARCHAR(10) NOT NULL',
+               'attempts': 'INTEGER NOT NULL DEFAULT 0',
+               'last_error': 'TEXT',
+               'updated_at': 'REAL NOT NULL',
+               'lease_owner': 'VARCHAR(100)',
+               'lease_expires': 'REAL'}
+
+    # runnable: pending, or running under an expired lease with attempts left, and every previous phase of the
+    # episode is done
+    CLAIMABLE_CONDITION = '(t.status = ? OR (t.status = ? AND t.lease_expires < ? AND t.attempts < ?)) ' \
+                          'AND NOT EXISTS (SELECT 1 FROM task p WHERE p.episode_no = t.episode_no ' \
+                          'AND p.phase_order < t.phase_order AND p.status != ?)'
+
+    def __init__(self, db_path, max_attempts=3, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.conn = self._connect(db_path)
+        self._create_table()
+
+    def _connect(self, db_path):
+        # autocommit mode, transactions are started explicitly where they are needed
+        conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _create_table(self):
+        columns = ', '.join(f'{name} {definition}' for name, definition in TaskQueue.COLUMNS.items())
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS task ({columns}, PRIMARY KEY (episode_no, phase))')
+        # queues created before leases were introduced
+        existing = [row[1] for row in self.conn.execute('PRAGMA table_info(task)').fetchall()]
+        for name, definition in TaskQueue.COLUMNS.items():
+            if name not in existing:
+                self.conn.execute(f'ALTER TABLE task ADD COLUMN {name} {definition}')
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, episodes, phases):
+        """ Adds a task for each phase of each episode, tasks that already exist are left untouched
+
+        :param episodes: episode numbers
+        :param phases: phase names, in the order they have to run in
+        :return: number of tasks added
+        """
+        now = time.time()
+        rows = [(ep, phase, order, TaskQueue.STATUS_PENDING, now)
+                for ep in dict.fromkeys(int(ep) for ep in episodes) for order, phase in enumerate(phases)]
+        before = self.conn.total_changes
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT OR IGNORE INTO task (episode_no, phase, phase_order, status, updated_at) '
+                              'VALUES (?, ?, ?, ?, ?)', rows)
+        self.conn.execute('COMMIT')
+        added = self.conn.total_changes - before
+        logger.info(f'{added} tasks added to queue ({len(rows) - added} already queued)')
+        return added
+
+    def retry_failed(self):
+        """ Returns failed tasks to the queue with a fresh set of attempts
+
+        :return: number of tasks returned to the queue
+        """
+        cursor = self.conn.execute('UPDATE task SET status = ?, attempts = 0, updated_at = ? WHERE status = ?',
+                                   (TaskQueue.STATUS_PENDING, time.time(), TaskQueue.STATUS_FAILED))
+        return cursor.rowcount
+
+    def _claimable_params(self, now):
+        return TaskQueue.STATUS_PENDING, TaskQueue.STATUS_RUNNING, now, self.max_attempts, TaskQueue.STATUS_DONE
+
+    def _fail_expired(self, now):
+        """ Marks failed the tasks whose lease expired on their last attempt, together with the later phases of their
+        episodes. The worker never got to call fail() (e.g. it was killed by the OOM killer or crashed in native code),
+        so running such a task again could take down another worker. """
+        cursor = self.conn.execute('UPDATE task SET status = ?, last_error = ?, lease_owner = NULL, '
+                                   'lease_expires = NULL, updated_at = ? '
+                                   'WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                                   (TaskQueue.STATUS_FAILED, 'lease expired on the last attempt', now,
+                                    TaskQueue.STATUS_RUNNING, now, self.max_attempts))
+        if cursor.rowcount > 0:
+            logger.warning(f'{cursor.rowcount} tasks lost their worker on their last attempt, marked failed')
+            self.conn.execute('UPDATE task SET status = ?, last_error = ?, updated_at = ? '
+                              'WHERE status = ? AND EXISTS (SELECT 1 FROM task f WHERE f.episode_no = task.episode_no '
+                              'AND f.phase_order < task.phase_order AND f.status = ?)',
+                              (TaskQueue.STATUS_FAILED, 'previous phase failed', now, TaskQueue.STATUS_PENDING,
+                               TaskQueue.STATUS_FAILED))
+
+    def claim(self, owner=None):
+        """ Claims the next runnable task and takes a lease on it
+
+        :param owner: identifies the worker holding the lease, defaults to <hostname>:<pid>
+        :return: Task, or None if no task can run right now
+        """
+        owner = owner or default_owner()
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._fail_expired(now)
+            row = self.conn.execute(
+                f'SELECT t.episode_no, t.phase, t.attempts, t.status FROM task t '
+                f'WHERE {TaskQueue.CLAIMABLE_CONDITION} ORDER BY t.episode_no, t.phase_order LIMIT 1',
+                self._claimable_params(now)).fetchone()
+            if row is None:
+                self.conn.execute('COMMIT')
+                return None
+            episode_no, phase, attempts, status = row
+            self.conn.execute('UPDATE task SET status = ?, attempts = ?, lease_owner = ?, lease_expires = ?, '
+                              'updated_at = ? WHERE episode_no = ? AND phase = ?',
+                              (TaskQueue.STATUS_RUNNING, attempts + 1, owner, now + self.lease_seconds, now,
+                               episode_no, phase))
+            self.conn.execute('COMMIT')
+        except sqlite3.Error as ex:
+            self.conn.execute('ROLLBACK')
+            raise ex
+        task = Task(episode_no, phase, attempts + 1, owner)
+        if status == TaskQueue.STATUS_RUNNING:
+            logger.warning(f'Lease on {task} expired, reassigned to {owner}')
+        return task
+
+    def heartbeat(self, task):
+        """ Renews the lease on a task
+
+        :return: whether the lease is still held, False if it expired and the task was reassigned
+        """
+        now = time.time()
+        cursor = self.conn.execute('UPDATE task SET lease_expires = ?, updated_at = ? '
+                                   'WHERE episode_no = ? AND phase = ? AND status = ? AND lease_owner = ?',
+                                   (now + self.lease_seconds, now, task.episode_no, task.phase,
+                                    TaskQueue.STATUS_RUNNING, task.owner))
+        return cursor.rowcount == 1
+
+    def complete(self, task):
+        if not self._release(task, TaskQueue.STATUS_DONE, None):
+            logger.warning(f'{task} completed after its lease was lost')
+
+    def fail(self, task, error):
+        """ Returns the task to the queue to be retried, or marks it failed once it has run out of attempts """
+        status = TaskQueue.STATUS_PENDING if task.attempts < self.max_attempts else TaskQueue.STATUS_FAILED
+        if not self._release(task, status, str(error)):
+            logger.warning(f'{task} failed after its lease was lost: {error}')
+            return
+        logger.warning(f'{task} failed (attempt {task.attempts}/{self.max_attempts}): {error}')
+        if status == TaskQueue.STATUS_FAILED:
+            # later phases of the episode can never run
+            self.conn.execute('UPDATE task SET status = ?, last_error = ?, updated_at = ? '
+                              'WHERE episode_no = ? AND status = ? AND phase_order > '
+                              '(SELECT phase_order FROM task WHERE episode_no = ? AND phase = ?)',
+                              (TaskQueue.STATUS_FAILED, f'{task.phase} failed', time.time(), task.episode_no,
+                               TaskQueue.STATUS_PENDING, task.episode_no, task.phase))
+
+    def _release(self, task, status, error):
+        """ Sets the status of a task whose lease is held by task.owner, returns False if the lease was lost """
+        cursor = self.conn.execute('UPDATE task SET status = ?, last_error = ?, lease_owner = NULL, '
+                                   'lease_expires = NULL, updated_at = ? '
+                                   'WHERE episode_no = ? AND phase = ? AND status = ? AND lease_owner = ?',
+                                   (status, error, time.time(), task.episode_no, task.phase,
+                                    TaskQueue.STATUS_RUNNING, task.owner))
+        return cursor.rowcount == 1
+
+    def has_unfinished(self):
+        """ Whether any task may still run, i.e. is pending or running """
+        row = self.conn.execute('SELECT COUNT(*) FROM task WHERE status IN (?, ?)',
+                                (TaskQueue.STATUS_PENDING, TaskQueue.STATUS_RUNNING)).fetchone()
+        return row[0] > 0
+
+    def summary(self):
+        """ Number of tasks by status """
+        return dict((status, count) for status, count in
+                    self.conn.execute('SELECT status, COUNT(*) FROM task GROUP BY status').fetchall())
+
+
+class SqlServerTaskQueue(TaskQueue):
+    """ Same queue in the dbo.task table of SQL Server (see sql/create_tables.sql) """
+
+    def _connect(self, connection_string):
+        import pyodbc
+        return pyodbc.connect(connection_string, autocommit=True)
+
+    def _create_table(self):
+        # the table is created with the rest of the schema in sql/create_tables.sql
+        pass
+
+    def add(self, episodes, phases):
+        now = time.time()
+        rows = [(ep, phase, ep, phase, order, TaskQueue.STATUS_PENDING, now)
+                for ep in dict.fromkeys(int(ep) for ep in episodes) for order, phase in enumerate(phases)]
+        before = self._count()
+        cursor = self.conn.cursor()
+        cursor.executemany('MERGE task WITH (HOLDLOCK) AS t '
+                           'USING (SELECT ? AS episode_no, ? AS phase) AS s '
+                           'ON t.episode_no = s.episode_no AND t.phase = s.phase '
+                           'WHEN NOT MATCHED THEN INSERT (episode_no, phase, phase_order, status, updated_at) '
+                           'VALUES (?, ?, ?, ?, ?);', rows)
+        # pyodbc does not report the rows merged by executemany, count them instead (schedulers on other nodes
+        # adding tasks at the same time are counted too)
+        added = self._count() - before
+        logger.info(f'{added} tasks added to queue ({len(rows) - added} already queued)')
+        return added
+
+    def _count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM task').fetchone()[0]
+
+    def claim(self, owner=None):
+        owner = owner or default_owner()
+        now = time.time()
+        self._fail_expired(now)
+        # READPAST skips rows locked by workers claiming at the same time, UPDLOCK keeps them from claiming ours
+        row = self.conn.execute(
+            f'WITH next_task AS (SELECT TOP (1) * FROM task t WITH (UPDLOCK, READPAST, ROWLOCK) '
+            f'WHERE {TaskQueue.CLAIMABLE_CONDITION} ORDER BY t.episode_no, t.phase_order) '
+            f'UPDATE next_task SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, '
+            f'updated_at = ? OUTPUT inserted.episode_no, inserted.phase, inserted.attempts, deleted.status;',
+            self._claimable_params(now) + (TaskQueue.STATUS_RUNNING, owner, now + self.lease_seconds, now)
+        ).fetchone()
+        if row is None:
+            return None
+        episode_no, phase, attempts, status = row
+        task = Task(episode_no, phase, attempts, owner)
+        if status == TaskQueue.STATUS_RUNNING:
+            logger.warning(f'Lease on {task} expired, reassigned to {owner}')
+        return task
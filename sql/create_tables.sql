@@ -1,3 +1,4 @@
+drop table if exists dbo.task;
 drop table if exists dbo.skull;
 drop table if exists dbo.episode;
 
@@ -17,7 +18,7 @@ create table skull
     id            int identity
         constraint skull_pk
             primary key nonclustered,
-    member        text not null,
+    member        nvarchar(100) not null,
     time_appeared time not null,
     episode_no    int  not null
         constraint skull_episode_epNo_fk
@@ -29,3 +30,33 @@ create unique index skull_id_uindex
     on skull (id)
 go
 
+-- one row per skull, see db_write_mode in the [Phase3] config, stored in episode order
+create unique clustered index skull_episode_time_uindex
+    on skull (episode_no, time_appeared)
+go
+
+-- burns of a member (the clustered index columns are carried by every index)
+create index skull_member_index
+    on skull (member)
+go
+
+
+-- work queue shared by scheduler workers (infinitechallenge/utils/task_queue.py)
+create table task
+(
+    episode_no    int          not null,
+    phase         varchar(20)  not null,
+    phase_order   int          not null,
+    status        varchar(10)  not null,
+    attempts      int          not null default 0,
+    last_error    text,
+    updated_at    float        not null,
+    lease_owner   varchar(100),
+    lease_expires float,
+    constraint task_pk primary key (episode_no, phase)
+)
+go
+
+create index task_status_index
+    on task (status, episode_no, phase_order)
+go
@@ -0,0 +1,13 @@
+-- one-off cleanup of the duplicate rows left by re-running phase 3 with plain inserts: keeps the first row of every
+-- (episode_no, time_appeared), then adds the unique index of create_tables.sql so that duplicates cannot come back
+with ranked as
+         (select row_number() over (partition by episode_no, time_appeared order by id) as n
+          from skull)
+delete
+from ranked
+where n > 1
+go
+
+create unique index skull_episode_time_uindex
+    on skull (episode_no, time_appeared)
+go
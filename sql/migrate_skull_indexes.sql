@@ -0,0 +1,32 @@
+-- brings a skull table created before the indexes of create_tables.sql up to date: member becomes nvarchar(100), as
+-- text columns cannot be indexed, the table is clustered on (episode_no, time_appeared) instead of being a heap and
+-- member gets its own index. Run dedupe_skull.sql first if the table may hold duplicate rows.
+alter table skull
+    add member_nvarchar nvarchar(100)
+go
+
+update skull
+set member_nvarchar = convert(nvarchar(100), member)
+go
+
+alter table skull
+    drop column member
+go
+
+exec sp_rename 'skull.member_nvarchar', 'member', 'COLUMN'
+go
+
+alter table skull
+    alter column member nvarchar(100) not null
+go
+
+drop index if exists skull_episode_time_uindex on skull
+go
+
+create unique clustered index skull_episode_time_uindex
+    on skull (episode_no, time_appeared)
+go
+
+create index skull_member_index
+    on skull (member)
+go
@@ -0,0 +1,84 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Description: Local stand-in for Drive and S3 downloads
+# Answers HEAD and (ranged) GET requests for {path: bytes}, records the requests it received and can cut responses
+# short to simulate connections dropped part way through a download.
+
+
+class ObjectServer(ThreadingHTTPServer):
+    def __init__(self, objects):
+        super().__init__(('127.0.0.1', 0), ObjectHandler)
+        self.objects = objects
+        # (method, path, Range header) of every request received
+        self.requests = []
+        # number of upcoming GET responses to cut short half way through
+        self.truncate = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def ranges(self, path):
+        """ Range headers of the GET requests for path """
+        with self.lock:
+            return [byte_range for method, p, byte_range in self.requests if method == 'GET' and p == path]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _object(self, method):
+        path = self.path.split('?')[0]
+        with self.server.lock:
+            self.server.requests.append((method, path, self.headers.get('Range')))
+        return self.server.objects.get(path)
+
+    def _send_headers(self, status, length, extra=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', '"stub"')
+        self.send_header('Last-Modified', 'Mon, 19 Oct 2026 00:00:00 GMT')
+        for name, value in extra:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        data = self._object('HEAD')
+        if data is None:
+            self._send_headers(404, 0)
+        else:
+            self._send_headers(200, len(data))
+
+    def do_GET(self):
+        data = self._object('GET')
+        if data is None:
+            self._send_headers(404, 0)
+            return
+        first, last = 0, len(data) - 1
+        status, extra = 200, []
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            first, last = int(first), min(int(last or len(data) - 1), len(data) - 1)
+            status, extra = 206, [('Content-Range', f'bytes {first}-{last}/{len(data)}')]
+        with self.server.lock:
+            truncate = self.server.truncate > 0
+            self.server.truncate -= truncate
+        self._send_headers(status, last - first + 1, extra)
+        end = first + (last + 1 - first) // 2 if truncate else last + 1
+        self.wfile.write(memoryview(data)[first:end])
+        if truncate:
+            # the client sees the connection close before Content-Length bytes arrived
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,119 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from infinitechallenge.model.known_faces import KnownFaces, load_known_faces
+
+
+def random_known_faces(rng, n=20, names=('a', 'b', 'c')):
+    return KnownFaces(rng.normal(size=(n, 128)), rng.integers(0, len(names), size=n), names)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_save_replaces_store_and_keeps_previous_version(tmp_path, rng):
+    store_path = str(tmp_path / 'store')
+    first, second, third = (random_known_faces(rng) for _ in range(3))
+    first.save(store_path)
+    # a reader that resolved the store before the next save can still load it
+    resolved = os.path.realpath(store_path)
+    second.save(store_path)
+    assert np.array_equal(KnownFaces.load(resolved).encodings, first.encodings)
+    assert np.array_equal(load_known_faces(store_path).encodings, second.encodings)
+    third.save(store_path)
+    assert not os.path.exists(resolved)
+    assert np.array_equal(load_known_faces(store_path).encodings, third.encodings)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_save_replaces_plain_directory_store(tmp_path, rng):
+    store_path = str(tmp_path / 'store')
+    old, new = random_known_faces(rng), random_known_faces(rng)
+    old.save(store_path)
+    # stores written before versioning are plain directories
+    resolved = os.path.realpath(store_path)
+    os.remove(store_path)
+    shutil.move(resolved, store_path)
+    new.save(store_path)
+    assert os.path.islink(store_path)
+    assert np.array_equal(load_known_faces(store_path).encodings, new.encodings)
+
+
+def compare_faces_vote(data, encoding, tolerance=KnownFaces.DEFAULT_TOLERANCE):
+    """ The matching that KnownFaces.match replaced: face_recognition.compare_faces, then the counts vote """
+    # face_recognition.compare_faces(known, encoding, tolerance) is face_distance(known, encoding) <= tolerance
+    matches = list(np.linalg.norm(np.asarray(data['encodings']) - encoding, axis=1) <= tolerance)
+    name = KnownFaces.NAME_UNKNOWN
+    if True in matches:
+        counts = {}
+        for i in [i for (i, b) in enumerate(matches) if b]:
+            name = data['names'][i]
+            counts[name] = counts.get(name, 0) + 1
+        name = max(counts, key=counts.get)
+    return name
+
+
+def known_face_data(rng, people=8, per_person=40):
+    """ Known encodings in clusters per person, float32 values held in float64 arrays like dlib's encodings """
+    encodings, names = [], []
+    for person in range(people):
+        centre = rng.normal(scale=0.05, size=128)
+        for _ in range(per_person):
+            encodings.append((centre + rng.normal(scale=0.02, size=128)).astype(np.float32).astype(np.float64))
+            names.append(f'person{person}')
+    order = rng.permutation(len(names))
+    return {'encodings': [encodings[i] for i in order], 'names': [names[i] for i in order]}
+
+
+def boundary_queries(rng, data, tolerance=KnownFaces.DEFAULT_TOLERANCE):
+    """ Queries at distance tolerance (give or take a float32 step) of a known encoding """
+    queries = []
+    for i in rng.choice(len(data['encodings']), size=200):
+        direction = rng.normal(size=128)
+        direction /= np.linalg.norm(direction)
+        for offset in (-1e-7, 0.0, 1e-7):
+            queries.append((data['encodings'][i] + direction * (tolerance + offset)).astype(np.float32))
+    return queries
+
+
+def tie_data():
+    """ Two people with one encoding each at the same distance from the query, then a third with two """
+    zero = np.zeros(128)
+    encodings = [zero + 0.01, zero - 0.01, zero + 0.02, zero - 0.02, zero + 0.5]
+    return {'encodings': [e.astype(np.float32).astype(np.float64) for e in encodings],
+            'names': ['b', 'a', 'c', 'a', 'c']}
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_match_names_as_compare_faces_vote(rng, index):
+    data = known_face_data(rng)
+    known_faces = KnownFaces.from_data(data)
+    if index:
+        known_faces.build_index(leaf_size=8)
+    # between two known encodings, often of different people, so that several names get votes
+    pairs = rng.choice(len(data['encodings']), size=(100, 2))
+    mixed = [((data['encodings'][i] + data['encodings'][j]) / 2 + rng.normal(scale=0.02, size=128)).astype(np.float32)
+             for i, j in pairs]
+    near = [(e + rng.normal(scale=0.03, size=128)).astype(np.float32) for e in data['encodings'][:100]]
+    boundary = boundary_queries(rng, data)
+    for queries in (mixed, near, boundary):
+        expected = [compare_faces_vote(data, query) for query in queries]
+        assert known_faces.match(queries) == expected
+    # both sides of the tolerance are exercised
+    distances = [np.linalg.norm(np.asarray(data['encodings']) - query, axis=1).min() for query in boundary]
+    tolerance = KnownFaces.DEFAULT_TOLERANCE
+    assert any(d <= tolerance for d in distances) and any(d > tolerance for d in distances)
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_match_breaks_ties_as_compare_faces_vote(index):
+    data = tie_data()
+    known_faces = KnownFaces.from_data(data, index=index)
+    queries = [np.zeros(128, dtype=np.float32), np.full(128, 0.01, dtype=np.float32),
+               np.full(128, 0.3, dtype=np.float32)]
+    for tolerance in (0.15, 0.25, 0.35, 5.0):
+        expected = [compare_faces_vote(data, query, tolerance) for query in queries]
+        assert known_faces.match(queries, tolerance) == expected
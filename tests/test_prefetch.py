@@ -0,0 +1,74 @@
+import hashlib
+import os
+import pytest
+import requests
+from http_stub import ObjectServer
+from infinitechallenge.utils.prefetch import Prefetcher
+from infinitechallenge.utils.ranged_download import ChecksumError, RangedDownloader
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture
+def data():
+    return os.urandom(10 * CHUNK + 123)
+
+
+@pytest.fixture
+def server(data):
+    with ObjectServer({'/episode1.mp4': data}) as server:
+        yield server
+
+
+def ranged_download(server, data, md5=None):
+    """ Download function of the prefetcher, giving up on a range at the first dropped connection """
+    def download(name, output_path):
+        downloader = RangedDownloader(requests.Session, chunk_size=CHUNK, parallelism=1, max_retries=0)
+        downloader.download(f'{server.url}/{name}', output_path, len(data), md5)
+    return download
+
+
+@pytest.fixture
+def cache_directory(tmp_path):
+    return str(tmp_path / 'prefetch')
+
+
+def test_failed_download_is_resumed(server, data, cache_directory):
+    prefetcher = Prefetcher(ranged_download(server, data), cache_directory, 1 << 30)
+    try:
+        server.truncate = 1
+        with pytest.raises(IOError):
+            prefetcher.get('episode1.mp4')
+        # the partial file and the ranges it holds are kept for the next request
+        assert sorted(os.listdir(cache_directory)) == ['episode1.mp4.part', 'episode1.mp4.part.ranges.json']
+        requested = len(server.ranges('/episode1.mp4'))
+        with open(prefetcher.get('episode1.mp4'), 'rb') as f:
+            assert f.read() == data
+        assert len(server.ranges('/episode1.mp4')) - requested < 11
+        assert os.listdir(cache_directory) == ['episode1.mp4']
+        prefetcher.release('episode1.mp4')
+        assert os.listdir(cache_directory) == []
+    finally:
+        prefetcher.close()
+
+
+def test_corrupt_download_is_discarded(server, data, cache_directory):
+    prefetcher = Prefetcher(ranged_download(server, data, hashlib.md5(b'other').hexdigest()), cache_directory,
+                            1 << 30)
+    try:
+        with pytest.raises(ChecksumError):
+            prefetcher.get('episode1.mp4')
+        assert os.listdir(cache_directory) == []
+    finally:
+        prefetcher.close()
+
+
+def test_release_removes_partial_download(server, data, cache_directory):
+    prefetcher = Prefetcher(ranged_download(server, data), cache_directory, 1 << 30)
+    try:
+        server.truncate = 1
+        prefetcher.prefetch('episode1.mp4')
+        prefetcher.release('episode1.mp4')
+        assert os.listdir(cache_directory) == []
+    finally:
+        prefetcher.close()
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import pytest
+import requests
+from http_stub import ObjectServer
+from infinitechallenge.utils.ranged_download import ChecksumError, RangedDownloader
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture
+def data():
+    return os.urandom(10 * CHUNK + 123)
+
+
+@pytest.fixture
+def server(data):
+    with ObjectServer({'/episode1.mp4': data}) as server:
+        yield server
+
+
+def download(server, output_path, data, parallelism=4, max_retries=5, md5=None):
+    downloader = RangedDownloader(requests.Session, chunk_size=CHUNK, parallelism=parallelism,
+                                  max_retries=max_retries, backoff=0.01, block_size=4096)
+    return downloader.download(f'{server.url}/episode1.mp4', str(output_path), len(data), md5)
+
+
+def test_download_is_byte_identical(server, data, tmp_path):
+    output_path = tmp_path / 'episode1.mp4'
+    download(server, output_path, data, md5=hashlib.md5(data).hexdigest())
+    assert output_path.read_bytes() == data
+    assert len(server.ranges('/episode1.mp4')) == 11
+    assert not os.path.exists(f'{output_path}.ranges.json')
+
+
+def test_dropped_range_resumes_from_last_byte_written(server, data, tmp_path):
+    output_path = tmp_path / 'episode1.mp4'
+    server.truncate = 1
+    download(server, output_path, data, parallelism=1)
+    assert output_path.read_bytes() == data
+    # the retry only asks for the second half of the first range
+    assert server.ranges('/episode1.mp4')[:2] == [f'bytes=0-{CHUNK - 1}', f'bytes={CHUNK // 2}-{CHUNK - 1}']
+
+
+def test_interrupted_download_resumes_completed_ranges(server, data, tmp_path):
+    output_path = tmp_path / 'episode1.mp4'
+    server.truncate = 1
+    with pytest.raises(IOError):
+        download(server, output_path, data, parallelism=1, max_retries=0)
+    with open(f'{output_path}.ranges.json', encoding='utf8') as f:
+        done = json.load(f)['done']
+    assert 0 not in done
+    requested = len(server.ranges('/episode1.mp4'))
+    download(server, output_path, data, parallelism=1)
+    assert output_path.read_bytes() == data
+    # the ranges completed by the first attempt are not downloaded again
+    resumed = server.ranges('/episode1.mp4')[requested:]
+    assert len(resumed) == 11 - len(done) and f'bytes=0-{CHUNK - 1}' in resumed
+
+
+def test_checksum_mismatch_raises(server, data, tmp_path):
+    with pytest.raises(ChecksumError):
+        download(server, tmp_path / 'episode1.mp4', data, md5=hashlib.md5(b'other').hexdigest())
@@ -0,0 +1,57 @@
+import os
+import boto3
+import pytest
+from botocore.config import Config
+from http_stub import ObjectServer
+from infinitechallenge.utils.s3_util import MB, s3_download_to_file
+
+CHUNK = 1 * MB
+
+
+@pytest.fixture
+def data():
+    return os.urandom(5 * CHUNK + 123)
+
+
+@pytest.fixture
+def server(data):
+    with ObjectServer({'/episodes/episode1.mp4': data}) as server:
+        yield server
+
+
+@pytest.fixture
+def s3(server):
+    return boto3.client('s3', endpoint_url=server.url, region_name='us-east-1', aws_access_key_id='stub',
+                        aws_secret_access_key='stub', config=Config(s3={'addressing_style': 'path'}))
+
+
+def test_ranged_download_is_byte_identical(s3, server, data, tmp_path):
+    output_path = str(tmp_path / 'episode1.mp4')
+    s3_download_to_file(s3, 'episodes', 'episode1.mp4', output_path, chunksize=CHUNK, concurrency=4)
+    with open(output_path, 'rb') as f:
+        assert f.read() == data
+    # one ranged GET per chunk (the last one open-ended)
+    ranges = server.ranges('/episodes/episode1.mp4')
+    assert sorted(byte_range.split('=')[1].split('-')[0] for byte_range in ranges) == \
+        sorted(str(start) for start in range(0, len(data), CHUNK))
+
+
+def test_dropped_range_is_downloaded_again(s3, server, data, tmp_path):
+    output_path = str(tmp_path / 'episode1.mp4')
+    server.truncate = 1
+    s3_download_to_file(s3, 'episodes', 'episode1.mp4', output_path, chunksize=CHUNK, concurrency=1)
+    with open(output_path, 'rb') as f:
+        assert f.read() == data
+    # only the dropped range is requested again
+    ranges = server.ranges('/episodes/episode1.mp4')
+    assert len(ranges) == 7 and len(set(ranges)) == 6
+
+
+def test_streamed_download_is_byte_identical(s3, server, data, tmp_path):
+    output_path = str(tmp_path / 'episode1.mp4')
+    progress = []
+    s3_download_to_file(s3, 'episodes', 'episode1.mp4', output_path, chunksize=CHUNK, on_progress=progress.append)
+    with open(output_path, 'rb') as f:
+        assert f.read() == data
+    assert progress[-1] == len(data) and progress == sorted(progress)
+    assert server.ranges('/episodes/episode1.mp4') == [None]
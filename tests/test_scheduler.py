@@ -0,0 +1,51 @@
+import configparser
+import pytest
+
+from infinitechallenge.pipeline.scheduler import check_mode, read_episode_numbers
+from infinitechallenge.utils.task_queue import TaskQueue
+
+
+@pytest.fixture
+def episode_info(tmp_path):
+    # one row per segment: episodes 2 and 4 have several segments
+    path = tmp_path / 'episode_info.csv'
+    path.write_text('1,2006-05-06,Golf Putting Challenge,\n'
+                    '2,2006-05-13,Space Special #1,\n'
+                    '2,2006-05-13,Space Special #2,\n'
+                    '3,2006-05-20,Wedding Special,\n'
+                    '4,2006-05-27,World Cup Special #1,\n'
+                    '4,2006-05-27,World Cup Special #2,\n'
+                    '4,2006-05-27,World Cup Special #3,\n', encoding='utf8')
+    return str(path)
+
+
+def test_read_episode_numbers_dedupes_repeated_episodes(episode_info):
+    assert read_episode_numbers(episode_info, 1, 4) == [1, 2, 3, 4]
+    assert read_episode_numbers(episode_info, 2, 3) == [2, 3]
+
+
+def test_queue_adds_one_task_per_episode_and_phase(episode_info, tmp_path, caplog):
+    queue = TaskQueue(str(tmp_path / 'queue.sqlite'))
+    try:
+        assert queue.add(read_episode_numbers(episode_info, 1, 4), ['phase1', 'phase2']) == 8
+        assert queue.summary() == {TaskQueue.STATUS_PENDING: 8}
+        # repeated episodes are queued once, and tasks already queued are not counted again
+        assert queue.add([4, 4, 5, 5], ['phase1', 'phase2']) == 2
+        assert '2 tasks added to queue (2 already queued)' in caplog.text
+        assert queue.summary() == {TaskQueue.STATUS_PENDING: 10}
+    finally:
+        queue.close()
+
+
+def scheduler_config(**options):
+    config = configparser.ConfigParser()
+    config['Scheduler'] = options
+    return config['Scheduler']
+
+
+def test_shared_queue_requires_fused_mode_or_shared_output():
+    with pytest.raises(ValueError):
+        check_mode(scheduler_config(queue_backend='sqlserver', mode='phases'))
+    check_mode(scheduler_config(queue_backend='sqlserver', mode='fused'))
+    check_mode(scheduler_config(queue_backend='sqlserver', mode='phases', shared_output='true'))
+    check_mode(scheduler_config(queue_backend='sqlite', mode='phases'))
@@ -0,0 +1,129 @@
+import multiprocessing
+import time
+import pytest
+from infinitechallenge.utils.task_queue import TaskQueue
+
+PHASES = ['phase1', 'phase2']
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / 'queue.sqlite')
+
+
+@pytest.fixture
+def queue(queue_path):
+    queue = TaskQueue(queue_path, max_attempts=2, lease_seconds=0.2)
+    yield queue
+    queue.close()
+
+
+def status(queue, episode_no, phase):
+    return queue.conn.execute('SELECT status, lease_owner FROM task WHERE episode_no = ? AND phase = ?',
+                              (episode_no, phase)).fetchone()
+
+
+def test_claims_phases_in_order(queue):
+    queue.add([1], PHASES)
+    task = queue.claim('a')
+    assert (task.episode_no, task.phase, task.attempts) == (1, 'phase1', 1)
+    # phase2 waits for phase1
+    assert queue.claim('b') is None
+    queue.complete(task)
+    assert queue.claim('b').phase == 'phase2'
+
+
+def test_expired_lease_is_reassigned(queue):
+    queue.add([1], ['phase1'])
+    stale = queue.claim('a')
+    assert queue.claim('b') is None
+    time.sleep(0.3)
+    task = queue.claim('b')
+    assert (task.episode_no, task.phase, task.attempts, task.owner) == (1, 'phase1', 2, 'b')
+    assert not queue.heartbeat(stale)
+    assert queue.heartbeat(task)
+
+
+def test_heartbeat_extends_lease(queue):
+    queue.add([1], ['phase1'])
+    task = queue.claim('a')
+    for _ in range(3):
+        time.sleep(0.1)
+        assert queue.heartbeat(task)
+    # 0.3s after the claim, past the original lease
+    assert queue.claim('b') is None
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_RUNNING, 'a')
+
+
+def test_stale_owner_cannot_complete_or_fail(queue):
+    queue.add([1], ['phase1'])
+    stale = queue.claim('a')
+    time.sleep(0.3)
+    queue.claim('b')
+    queue.complete(stale)
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_RUNNING, 'b')
+    queue.fail(stale, 'stale failure')
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_RUNNING, 'b')
+
+
+def test_failed_task_is_retried_until_out_of_attempts(queue):
+    queue.add([1], PHASES)
+    queue.fail(queue.claim('a'), 'first failure')
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_PENDING, None)
+    task = queue.claim('a')
+    assert task.attempts == 2
+    queue.fail(task, 'second failure')
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_FAILED, None)
+    # the later phase can never run
+    assert status(queue, 1, 'phase2') == (TaskQueue.STATUS_FAILED, None)
+    assert not queue.has_unfinished()
+
+
+def test_task_fails_when_lease_expires_on_last_attempt(queue):
+    queue.add([1], PHASES)
+    queue.fail(queue.claim('a'), 'first failure')
+    # the worker dies on the last attempt
+    queue.claim('a')
+    time.sleep(0.3)
+    assert queue.claim('b') is None
+    assert status(queue, 1, 'phase1') == (TaskQueue.STATUS_FAILED, None)
+    assert status(queue, 1, 'phase2') == (TaskQueue.STATUS_FAILED, None)
+
+
+def test_retry_failed_resets_attempts(queue):
+    queue.add([1], ['phase1'])
+    queue.fail(queue.claim('a'), 'first failure')
+    queue.fail(queue.claim('a'), 'second failure')
+    assert queue.retry_failed() == 1
+    assert queue.claim('a').attempts == 1
+
+
+def claim_all(queue_path, owner, results):
+    queue = TaskQueue(queue_path, lease_seconds=60)
+    claimed = []
+    try:
+        while True:
+            task = queue.claim(owner)
+            if task is None:
+                break
+            claimed.append(task.episode_no)
+            queue.complete(task)
+    finally:
+        queue.close()
+    results.put(claimed)
+
+
+def test_concurrent_workers_never_claim_the_same_task(queue_path):
+    episodes = list(range(1, 201))
+    queue = TaskQueue(queue_path)
+    queue.add(episodes, ['phase1'])
+    queue.close()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=claim_all, args=(queue_path, f'worker{i}', results)) for i in range(4)]
+    for process in workers:
+        process.start()
+    claimed = [results.get(timeout=60) for _ in workers]
+    for process in workers:
+        process.join()
+    all_claimed = [ep for worker_claimed in claimed for ep in worker_claimed]
+    assert sorted(all_claimed) == episodes